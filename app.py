@@ -1,48 +1,389 @@
+import base64
+import bisect
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import random
+import sys
+import threading
+import time
 import psycopg2
-from flask import Flask, render_template, request
+from flask import Flask, abort, g, jsonify, render_template, request, send_from_directory, stream_with_context, url_for
 from lxml import etree
-from settings import config, connecttodb
+from assets import Assets, build
+from cache import LRUCache, Snapshot
+from feed import Feed
+from settings import config, options, connecttodb, releasedb, poolstats
+from queries import OCCUPANT_COLUMNS, fetchoccupancy, fetchoccupants, fetchroomdetails, fetchroompage, fetchrooms, fetchroomversion
 
 
-app = Flask(__name__)
+app = Flask(__name__, template_folder='Templates', static_folder='Static', static_url_path='/static')
+# templates are compiled once per process and never checked for changes
+# unless debugging, see wsgi.py
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+
+CACHE_DEFAULTS = {
+	# seconds between background reloads of the room list
+	'ttl': 30.0,
+	# past this age a request reloads the room list itself
+	'maxstale': 300.0,
+	# parsed room configurations kept for /roomdetails
+	'configs': 1024,
+}
+cacheopts = options('cache', CACHE_DEFAULTS)
+
+OCCUPANCY_DEFAULTS = {
+	# serve /occupants and room occupancy from an in-memory copy of tc_users
+	'enabled': False,
+	# seconds between background reloads of the copy
+	'ttl': 10.0,
+	# past this age a request reloads the copy itself
+	'maxstale': 60.0,
+}
+occupancyopts = options('occupancy', OCCUPANCY_DEFAULTS)
+
+STREAM_DEFAULTS = {
+	# seconds between checks of the room list for changes
+	'interval': 5.0,
+	# change batches kept for clients resuming with Last-Event-ID
+	'backlog': 100,
+	# seconds between keep-alive comments on an idle stream
+	'heartbeat': 15.0,
+	# seconds a stream stays open before the browser is sent off to
+	# reconnect, and so a worker thread is held
+	'maxage': 300.0,
+	# streams open at once per worker process; keep it below the threads
+	# per worker so pages and the api always find a free thread
+	'maxstreams': 8,
+	# seconds a browser turned away at maxstreams waits before retrying
+	'busyretry': 30.0,
+}
+streamopts = options('stream', STREAM_DEFAULTS)
+
+# fingerprinted files from `flask --app app build-assets`, read once per process
+assets = Assets()
+
+# a fingerprinted name always has the same content
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+@app.template_global()
+def asset_url(name):
+	built = assets.built(name)
+	if built is None:
+		return url_for('static', filename=name)
+	return url_for('asset', filename=built)
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+	if filename not in assets.encodings:
+		abort(404)
+	path, encoding = assets.variant(filename, request.accept_encodings)
+	# typed after the file it was compressed from, not as .gz/.br
+	response = send_from_directory(assets.dist, path, mimetype=mimetypes.guess_type(filename)[0])
+	if encoding:
+		response.headers['Content-Encoding'] = encoding
+	response.headers['Vary'] = 'Accept-Encoding'
+	response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % ASSET_MAX_AGE
+	return response
+
+def getcursor():
+	# pooled cursor for the current request, handed back in closedb()
+	cursor = connecttodb()
+	if cursor != '0':
+		g.dbcursor = cursor
+	return cursor
+
+@app.teardown_appcontext
+def closedb(exception):
+	cursor = g.pop('dbcursor', None)
+	if cursor is not None:
+		releasedb(cursor)
 
 @app.route("/")
 @app.route("/index")
 def index():
 		return render_template('index.html')
 
-@app.route('/rooms')
-def rooms():
+def loadrooms():
+	# also called from the snapshot refresher, outside of any request,
+	# so it checks its own connection out and back in
+	cursor = connecttodb()
+	if cursor == '0':
+		raise psycopg2.OperationalError('No connection to External DB')
+	try:
+		# with the occupancy index enabled the counts come from memory, see roomrows()
+		return fetchrooms(cursor, counts=occupancyindex is None)
+	finally:
+		releasedb(cursor)
+
+roomsnapshot = Snapshot(loadrooms, name='rooms', ttl=cacheopts['ttl'], maxstale=cacheopts['maxstale'])
+
+def loadoccupancy():
+	# room jid -> tuple of its occupant rows, in the order of fetchoccupants().
+	# role and affiliation take a handful of values, share one string each
 	cursor = connecttodb()
 	if cursor == '0':
+		raise psycopg2.OperationalError('No connection to External DB')
+	try:
+		index = {}
+		for room, realjid, role, affiliation, nickjid in fetchoccupancy(cursor):
+			index.setdefault(room, []).append((room, realjid, sys.intern(role or ''), sys.intern(affiliation or ''), nickjid))
+	finally:
+		releasedb(cursor)
+	return dict((room, tuple(rows)) for room, rows in index.items())
+
+occupancyindex = None
+if occupancyopts['enabled']:
+	occupancyindex = Snapshot(loadoccupancy, name='occupancy', ttl=occupancyopts['ttl'], maxstale=occupancyopts['maxstale'])
+
+def withoccupancy(rows, occupants):
+	# busiest first like ROOMS_SQL; rows come ordered by room_jid, which the stable sort keeps for ties
+	rows = [tuple(row[:4]) + (len(occupants.get(row[0], ())),) for row in rows]
+	rows.sort(key=lambda row: row[4], reverse=True)
+	return rows
+
+# room list with counts from the occupancy index, keyed by both digests
+roomrowscache = (None, None)
+
+def roomrows():
+	# the room snapshot and its etag, occupancy filled in from the index when enabled
+	# each snapshot is read as one (value, digest) pair so the rows always
+	# match the etag they are returned with
+	global roomrowscache
+	tc_rooms, digest = roomsnapshot.snapshot()
+	if occupancyindex is None:
+		return tc_rooms, digest
+	occupants, occdigest = occupancyindex.snapshot()
+	key = '%s-%s' % (digest, occdigest)
+	cached = roomrowscache
+	if cached[0] != key:
+		cached = (key, withoccupancy(tc_rooms, occupants))
+		roomrowscache = cached
+	return cached[1], key
+
+ROOMS_PAGE = 50
+ROOMS_PAGE_MAX = 500
+ROOM_SORTS = ('occupancy', 'name', 'subject')
+
+def encodecursor(values):
+	return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decodecursor(after):
+	try:
+		values = json.loads(base64.urlsafe_b64decode(after.encode('ascii')).decode('utf-8'))
+	except (ValueError, UnicodeError):
+		return None
+	if not isinstance(values, list) or len(values) != 2:
+		return None
+	return values
+
+def snapshotroompage(tc_rooms, q, limit, after):
+	# ordering by occupancy needs the full aggregate, which the snapshot already holds
+	if q:
+		q = q.lower()
+		tc_rooms = [row for row in tc_rooms if q in row[0].lower() or q in (row[2] or '').lower()]
+	tc_rooms = sorted(tc_rooms, key=lambda row: (-row[4], row[0]))
+	if after and isinstance(after[0], int):
+		keys = [(-row[4], row[0]) for row in tc_rooms]
+		tc_rooms = tc_rooms[bisect.bisect_right(keys, (-after[0], after[1])):]
+	return tc_rooms[:limit + 1]
+
+def roomcursor(row, sort):
+	if sort == 'name':
+		return encodecursor([None, row[0]])
+	if sort == 'subject':
+		return encodecursor([row[2] or '', row[0]])
+	return encodecursor([row[4], row[0]])
+
+@app.route('/rooms')
+def rooms():
+	q = request.args.get('q', '').strip()
+	sort = request.args.get('sort', 'occupancy')
+	if sort not in ROOM_SORTS:
+		sort = 'occupancy'
+	limit = max(1, min(request.args.get('limit', ROOMS_PAGE, type=int), ROOMS_PAGE_MAX))
+	after = request.args.get('after')
+	after = decodecursor(after) if after else None
+
+	try:
+		snapshot = roomrows()[0]
+		if sort == 'occupancy':
+			tc_rooms = snapshotroompage(snapshot, q, limit, after)
+		else:
+			cursor = getcursor()
+			if cursor == '0':
+				raise psycopg2.OperationalError('No connection to External DB')
+			tc_rooms = fetchroompage(cursor, q, sort, limit, after, counts=occupancyindex is None)
+			if occupancyindex is not None:
+				tc_rooms = withoccupancy(tc_rooms, occupancyindex.get())
+	except Exception:
 		tc_rooms = [('N/A@','','No connection to External DB','N/A','0','0')]
 		rows_affected = 0
-		return render_template('rooms.html', tc_rooms=tc_rooms, totalrooms=rows_affected)
+		return render_template('rooms.html', tc_rooms=tc_rooms, totalrooms=rows_affected, q=q, sort=sort, limit=limit, after=None, nextpage=None)
+
+	nextpage = None
+	if len(tc_rooms) > limit:
+		tc_rooms = tc_rooms[:limit]
+		nextpage = roomcursor(tc_rooms[-1], sort)
+	rows_affected = len(snapshot)
+	return render_template('rooms.html',tc_rooms=tc_rooms,totalrooms=rows_affected, q=q, sort=sort, limit=limit, after=after, nextpage=nextpage)
+
+
+MSGCOUNT_SQL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql', 'msgcount.sql')
+
+# rooms recounted per transaction by install-msgcount; archive writes wait
+# while one batch is counted
+MSGCOUNT_BATCH = 50
+
+ADHOC_ROOM = 'Ad-Hoc (temporary) room. Note: Temporary chat rooms are automatically destroyed when all users leave the room'
+
+def roomoccupants(room):
+	# from the occupancy index when enabled, otherwise from the database
+	if occupancyindex is not None:
+		return occupancyindex.get().get(room, ())
+	cursor = getcursor()
+	if cursor == '0':
+		raise psycopg2.OperationalError('No connection to External DB')
+	return fetchoccupants(cursor, room)
+
+FIELD_XPATH = etree.XPath('p:field', namespaces={'p': 'jabber:x:data'})
+
+# room jid -> (hash of the raw config, parsed dict)
+configcache = LRUCache(cacheopts['configs'])
+
+def parseconfig(rawconfig):
+	configDict = {}
+	if not rawconfig:
+		configDict['persistent'] = '0'
+		configDict['fixed'] = ADHOC_ROOM
+		return configDict
+	tree = etree.fromstring(rawconfig)
+	for r in FIELD_XPATH(tree):
+		for key in r.attrib:
+			configDict[r.attrib[key]] = r[0].text if r[0].text is not None else "N/A"
+	return configDict
+
+def roomconfig(room, rawconfig):
+	# reparse only when the stored config text changed; callers must not modify the result
+	digest = hashlib.md5(rawconfig.encode('utf-8')).hexdigest() if rawconfig else None
+	cached = configcache.load(room, lambda: (digest, parseconfig(rawconfig)), lambda cached: cached[0] == digest)
+	return cached[1]
+
+# /rooms/stream: the room list is diffed once per change for every viewer
+
+def roomstate():
+	tc_rooms, digest = roomrows()
+	return digest, dict((row[0], (row[2] or '', row[3], row[4])) for row in tc_rooms)
+
+def roomchanges(old, new):
+	changes = []
+	for room, (subject, roomtype, occupants) in new.items():
+		before = old.get(room)
+		if before is None:
+			changes.append({'change': 'created', 'room': room, 'subject': subject, 'type': roomtype, 'occupants': occupants})
+			continue
+		if before[0] != subject:
+			changes.append({'change': 'subject', 'room': room, 'subject': subject})
+		if before[2] != occupants:
+			changes.append({'change': 'occupancy', 'room': room, 'occupants': occupants})
+	for room in old:
+		if room not in new:
+			changes.append({'change': 'destroyed', 'room': room})
+	return changes
+
+roomfeed = Feed(roomstate, roomchanges, interval=streamopts['interval'], backlog=streamopts['backlog'], name='roomfeed')
+
+def sseevent(event, data, eventid=None):
+	message = 'event: %s\ndata: %s\n\n' % (event, json.dumps(data, separators=(',', ':'), default=str))
+	if eventid is not None:
+		message = 'id: %s\n' % eventid + message
+	return message
+
+# open /rooms/stream responses of this process
+streamslots = threading.BoundedSemaphore(streamopts['maxstreams'])
+
+@app.route('/rooms/stream')
+def roomstream():
+	# text/event-stream of room changes; room= narrows it to one room
+	room = request.args.get('room')
+	roomfeed.start()
+	epoch, sep, seq = (request.headers.get('Last-Event-ID') or '').partition(':')
+	if epoch == roomfeed.epoch and seq.isdigit():
+		after = int(seq)
+		resync = after > roomfeed.current()
 	else:
-		cursor.execute("select A.room_jid, A.creator_jid,A.subject,A.type,COALESCE(B.rocc,0) from tc_rooms A left join (select room_jid, count(room_jid) as rocc from tc_users where role != 'none' and role != 'mnone' group by room_jid) B on A.room_jid = B.room_jid order by B.rocc desc NULLS LAST")
-		tc_rooms = cursor.fetchall()
-		rows_affected = cursor.rowcount
-		return render_template('rooms.html',tc_rooms=tc_rooms,totalrooms=rows_affected)
+		# new viewer, or one that was following another worker
+		after = roomfeed.current()
+		resync = bool(epoch)
+
+	def events(after, resync):
+		# every open stream holds a worker thread. Past maxstreams the
+		# browser is told to come back later; a 503 would make EventSource
+		# give up for good
+		if not streamslots.acquire(False):
+			yield 'retry: %d\n\n' % (streamopts['busyretry'] * random.uniform(1.0, 1.5) * 1000)
+			return
+		try:
+			yield 'retry: 5000\n\n'
+			# spread out so the streams of one page load don't all reconnect together
+			deadline = time.time() + streamopts['maxage'] * random.uniform(0.8, 1.0)
+			while True:
+				if resync:
+					after = roomfeed.current()
+					yield sseevent('reload', {}, '%s:%d' % (roomfeed.epoch, after))
+					resync = False
+				left = deadline - time.time()
+				if left <= 0:
+					break
+				batches = roomfeed.wait(after, min(streamopts['heartbeat'], left))
+				if batches is None:
+					resync = True
+					continue
+				if not batches:
+					yield ': keep-alive\n\n'
+					continue
+				for seq, changes in batches:
+					if room:
+						changes = [change for change in changes if change['room'] == room]
+					after = seq
+					if changes:
+						yield sseevent('changes', changes, '%s:%d' % (roomfeed.epoch, seq))
+			# an id without data moves the browser's Last-Event-ID past the
+			# batches filtered out above; it reconnects and resumes from there
+			yield 'id: %s:%d\n\n' % (roomfeed.epoch, after)
+		finally:
+			streamslots.release()
 
+	response = app.response_class(stream_with_context(events(after, resync)), mimetype='text/event-stream')
+	response.headers['Cache-Control'] = 'no-cache'
+	# keep reverse proxies from buffering the stream
+	response.headers['X-Accel-Buffering'] = 'no'
+	return response
 
 @app.route('/occupants')
 def occupants():
 	room = request.args.get('room')
-	cursor = connecttodb()
-	if cursor == '0':
+	try:
+		tc_users = roomoccupants(room)
+	except psycopg2.Error:
 		tc_users = [('N/A@','No connection to External DB','N/A','N/A','/N/A')]
 		rows_affected = 0
 		return render_template('occupants.html', tc_users=tc_users, room=room, totalocc=rows_affected)
-	else:
-		cursor.execute("select * from tc_users where room_jid = '%s' and role != 'none' and role != 'mnone' order by role desc" % room)
-		tc_users = cursor.fetchall()
-		rows_affected = cursor.rowcount
-		return render_template('occupants.html', tc_users=tc_users, room=room,totalocc=rows_affected)
+	rows_affected = len(tc_users)
+	return render_template('occupants.html', tc_users=tc_users, room=room,totalocc=rows_affected)
+
+def roomdetailrows(cursor, room, occupants=None):
+	# details of room, with its occupancy counted from the index given one
+	if occupants is None:
+		return fetchroomdetails(cursor, room)
+	return [tuple(row[:5]) + (len(occupants.get(row[0], ())),) for row in fetchroomdetails(cursor, room, counts=False)]
 
 @app.route('/roomdetails')
 def roomdetails():
 	room = request.args.get('room')
-	cursor = connecttodb()
+	cursor = getcursor()
 	if cursor == '0':
 		configDict = {}
 		roomdetails = [('N/A@','N/A','No connection to External DB')]
@@ -50,22 +391,164 @@ def roomdetails():
 		configDict['fixed'] = 'No Connection to DB'
 		return render_template('roomdetails.html', room=room, roomdetails=roomdetails, configDict=configDict)
 	else:
-		cursor.execute("select A.room_jid, A.creator_jid,A.subject,A.config,COALESCE(C.msg,0),COALESCE(B.rocc,0) from tc_rooms A left join (select room_jid, count(room_jid) as rocc from tc_users where role != 'none' and role != 'mnone' group by room_jid) B on A.room_jid = B.room_jid left join (select to_jid, count(to_jid) as msg from tc_msgarchive group by to_jid) C on A.room_jid = C.to_jid where A.room_jid = '%s' order by B.rocc desc NULLS LAST" % room)
-		roomdetails = cursor.fetchall()
-		roomconfig = roomdetails[0][3]
-		configDict = {}
-		if roomconfig is "":
-			configDict['persistent'] = '0'
-			configDict['fixed'] = 'Ad-Hoc (temporary) room. Note: Temporary chat rooms are automatically destroyed when all users leave the room'
-			return render_template('roomdetails.html', room=room, roomdetails=roomdetails, configDict=configDict)
-		else:
-			tree = etree.fromstring(roomconfig)
-			nodes = tree.xpath('p:field', namespaces={'p': 'jabber:x:data'})
-			for r in nodes:
-				for key in r.attrib:
-					configDict[r.attrib[key]] = r[0].text if r[0].text is not None else "N/A"
-			return render_template('roomdetails.html', room=room, roomdetails=roomdetails, configDict=configDict)
+		roomdetails = roomdetailrows(cursor, room, occupancyindex.get() if occupancyindex is not None else None)
+		configDict = roomconfig(roomdetails[0][0], roomdetails[0][3])
+		return render_template('roomdetails.html', room=room, roomdetails=roomdetails, configDict=configDict)
+
+@app.route('/poolstats')
+def dbpoolstats():
+	stats = poolstats()
+	stats['configcache'] = configcache.stats()
+	if occupancyindex is not None:
+		stats['occupancy'] = {'rooms': len(occupancyindex.value or ()), 'age': round(occupancyindex.age(), 3)}
+	return jsonify(stats)
+
+# JSON mirror of the pages above for monitoring scripts.
+# responses carry an ETag so unchanged data is answered with a 304
+
+GZIP_MIN_SIZE = 512
+
+def encodejson(payload):
+	return json.dumps(payload, separators=(',', ':'), default=str).encode('utf-8')
+
+def jsonresponse(body, etag, gzbody=None):
+	gzipped = 'gzip' in request.accept_encodings and len(body) >= GZIP_MIN_SIZE
+	if gzipped:
+		etag += '-gz'
+	if request.if_none_match.contains(etag):
+		response = app.response_class(status=304)
+	else:
+		if gzipped:
+			body = gzbody if gzbody is not None else gzip.compress(body)
+		response = app.response_class(body, mimetype='application/json')
+		if gzipped:
+			response.headers['Content-Encoding'] = 'gzip'
+	response.set_etag(etag)
+	response.headers['Vary'] = 'Accept-Encoding'
+	return response
+
+def rowsetag(rows):
+	return hashlib.md5(repr(rows).encode('utf-8')).hexdigest()
+
+def notmodified(etag):
+	# 304 for a client already holding etag, checked before the data is fetched.
+	# jsonresponse() may have sent it with the -gz suffix
+	for tag in (etag, etag + '-gz'):
+		if request.if_none_match.contains(tag):
+			response = app.response_class(status=304)
+			response.set_etag(tag)
+			response.headers['Vary'] = 'Accept-Encoding'
+			return response
+	return None
+
+def dberror():
+	return jsonify(error='No connection to External DB'), 503
+
+# encoded room list, rebuilt only when the snapshot digest moves
+roomsjson = (None, None, None)
+
+@app.route('/api/v1/rooms')
+def apirooms():
+	global roomsjson
+	try:
+		tc_rooms, digest = roomrows()
+	except Exception:
+		return dberror()
+	etag, body, gzbody = roomsjson
+	if etag != digest:
+		etag = digest
+		body = encodejson([{'room': row[0], 'creator': row[1], 'subject': row[2], 'type': row[3], 'occupants': row[4]} for row in tc_rooms])
+		gzbody = gzip.compress(body)
+		roomsjson = (etag, body, gzbody)
+	return jsonresponse(body, etag, gzbody)
+
+@app.route('/api/v1/occupants')
+def apioccupants():
+	room = request.args.get('room')
+	if occupancyindex is not None:
+		# the index digest moves with any occupant change, no rows are hashed
+		occupants, digest = occupancyindex.snapshot()
+		etag = rowsetag((digest, room))
+		response = notmodified(etag)
+		if response is not None:
+			return response
+		tc_users = occupants.get(room, ())
+	else:
+		try:
+			tc_users = roomoccupants(room)
+		except psycopg2.Error:
+			return dberror()
+		etag = rowsetag(tc_users)
+	body = encodejson({'room': room, 'occupants': [dict(zip(OCCUPANT_COLUMNS, row)) for row in tc_users]})
+	return jsonresponse(body, etag)
+
+@app.route('/api/v1/roomdetails')
+def apiroomdetails():
+	room = request.args.get('room')
+	cursor = getcursor()
+	if cursor == '0':
+		return dberror()
+	# key lookups for the version; the config itself is only read when it changed
+	occupants = occupancyindex.get() if occupancyindex is not None else None
+	version = fetchroomversion(cursor, room, counts=occupants is None)
+	if version is not None:
+		if occupants is not None:
+			version = tuple(version) + (len(occupants.get(room, ())),)
+		etag = rowsetag(version)
+		response = notmodified(etag)
+		if response is not None:
+			return response
+	roomdetails = roomdetailrows(cursor, room, occupants)
+	if not roomdetails:
+		return jsonify(error='Room %s not found' % room), 404
+	row = roomdetails[0]
+	if version is None:
+		etag = rowsetag(roomdetails)
+	body = encodejson({'room': row[0], 'creator': row[1], 'subject': row[2], 'messages': row[4],
+		'occupants': row[5], 'config': roomconfig(row[0], row[3])})
+	return jsonresponse(body, etag)
+
+@app.cli.command('install-msgcount')
+def installmsgcount():
+	"""Install and backfill the per-room message counter table."""
+	with open(MSGCOUNT_SQL_FILE) as sqlfile:
+		sql = sqlfile.read()
+	con = psycopg2.connect(**config())
+	try:
+		with con:
+			with con.cursor() as cursor:
+				cursor.execute(sql)
+		# the triggers are counting now; every room with archived messages, and
+		# any counted before a reinstall, gets its count set from the archive
+		with con:
+			with con.cursor() as cursor:
+				cursor.execute("select to_jid from tc_msgarchive where to_jid is not null group by to_jid union select room_jid from jsat_room_msgcount")
+				recount = [row[0] for row in cursor.fetchall()]
+		for i in range(0, len(recount), MSGCOUNT_BATCH):
+			with con:
+				with con.cursor() as cursor:
+					cursor.execute("select jsat_msgcount_recount(%s)", (recount[i:i + MSGCOUNT_BATCH],))
+		with con:
+			with con.cursor() as cursor:
+				cursor.execute("select count(*), COALESCE(sum(msgs),0) from jsat_room_msgcount")
+				rooms, msgs = cursor.fetchone()
+	finally:
+		con.close()
+	print('jsat_room_msgcount installed: %d rooms, %d archived messages' % (rooms, msgs))
+
+@app.cli.command('build-assets')
+def buildassets():
+	"""Fingerprint, purge and precompress the static files the pages link."""
+	manifest, sizes = build()
+	for name in sorted(manifest):
+		size, built, gzsize, brsize = sizes[name]
+		print('%s -> %s: %d -> %d bytes, gzip %s, brotli %s' % (name, manifest[name], size, built,
+			gzsize if gzsize is not None else '-', brsize if brsize is not None else '-'))
+	print('restart the app to serve the new build')
 
 
 if  __name__ == "__main__":
-	app.run(debug=True, host="0.0.0.0", port=8080)
+	# development server only, production runs under gunicorn (see wsgi.py)
+	debug = os.environ.get('JSAT_DEBUG', '').lower() in ('1', 'true', 'yes')
+	app.config['TEMPLATES_AUTO_RELOAD'] = debug
+	app.run(debug=debug, threaded=True, host="0.0.0.0", port=int(os.environ.get('JSAT_PORT', 8080)))
@@ -0,0 +1,224 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# Build step for the files under Static/ that the pages link. Each file is
+# written to Static/dist under a name carrying a hash of its content, so it
+# can be cached forever, next to .gz and .br copies compressed at the
+# highest levels once instead of per request. manifest.json maps the
+# source names to the built ones for asset_url().
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASEDIR, 'Static')
+TEMPLATES_DIR = os.path.join(BASEDIR, 'Templates')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST = 'manifest.json'
+
+# what the templates link; the unminified copies and source maps are left out
+ASSETS = ('css/bootstrap.min.css', 'js/bootstrap.min.js', 'searchicon.png', 'xmpp-logo.svg')
+
+# stylesheets cut down to the selectors the templates use
+PURGE = ('css/bootstrap.min.css',)
+
+COMPRESS = ('.css', '.js', '.svg')
+
+# not worth a compressed copy below this size
+COMPRESS_MIN_SIZE = 512
+
+# classes bootstrap's javascript adds and removes itself
+SAFELIST = {'show', 'showing', 'collapse', 'collapsing', 'active', 'disabled', 'fade', 'focus'}
+
+CLASS_ATTR = re.compile(r'class="([^"]*)"')
+CLASS_JS = re.compile(r'classList\.(?:add|remove|toggle)\(\s*["\']([^"\']+)["\']')
+CLASS_SELECTOR = re.compile(r'\.(-?[_a-zA-Z][\w-]*)')
+NOT_SELECTOR = re.compile(r':not\([^)]*\)')
+SOURCEMAP_CSS = re.compile(r'/\*# sourceMappingURL=[^*]*\*/\s*$')
+SOURCEMAP_JS = re.compile(r'//# sourceMappingURL=[^\n]*\s*$')
+
+def fingerprint(name, data):
+	base, ext = os.path.splitext(name)
+	return '%s.%s%s' % (base, hashlib.md5(data).hexdigest()[:10], ext)
+
+def usedclasses(templates=TEMPLATES_DIR):
+	classes = set(SAFELIST)
+	for name in os.listdir(templates):
+		if not name.endswith('.html'):
+			continue
+		with open(os.path.join(templates, name)) as template:
+			text = template.read()
+		for attr in CLASS_ATTR.findall(text):
+			classes.update(token for token in attr.split() if '{' not in token and '}' not in token)
+		classes.update(CLASS_JS.findall(text))
+	return classes
+
+def blocks(css):
+	'''
+	Top level rules of css as (prelude, body) pairs, body being None for
+	statements such as @charset. Comments at the top level come back as
+	their own prelude with a None body.
+	'''
+	i = 0
+	n = len(css)
+	while i < n:
+		if css.startswith('/*', i):
+			end = css.find('*/', i + 2)
+			end = n if end < 0 else end + 2
+			yield css[i:end], None
+			i = end
+			continue
+		if css[i].isspace():
+			i += 1
+			continue
+		start = i
+		quote = None
+		while i < n:
+			c = css[i]
+			if quote:
+				if c == '\\':
+					i += 1
+				elif c == quote:
+					quote = None
+			elif c in '"\'':
+				quote = c
+			elif c in '{;':
+				break
+			i += 1
+		if i >= n or css[i] == ';':
+			yield css[start:i + 1], None
+			i += 1
+			continue
+		prelude = css[start:i]
+		depth = 0
+		bodystart = i + 1
+		while i < n:
+			c = css[i]
+			if quote:
+				if c == '\\':
+					i += 1
+				elif c == quote:
+					quote = None
+			elif c in '"\'':
+				quote = c
+			elif c == '{':
+				depth += 1
+			elif c == '}':
+				depth -= 1
+				if depth == 0:
+					break
+			i += 1
+		yield prelude, css[bodystart:i]
+		i += 1
+
+def keepselector(selector, classes):
+	return all(name in classes for name in CLASS_SELECTOR.findall(NOT_SELECTOR.sub('', selector)))
+
+def purgecss(css, classes):
+	'''
+	css without the rules whose selectors all name a class missing from
+	classes, and without at-rule blocks left empty by that. Rules that
+	name no class, e.g. on elements, stay.
+	'''
+	out = []
+	for prelude, body in blocks(css):
+		if body is None:
+			if prelude.startswith('/*!') or not prelude.startswith('/*'):
+				out.append(prelude)
+			continue
+		head = prelude.strip()
+		if head.startswith(('@media', '@supports', '@document')):
+			inner = purgecss(body, classes)
+			if inner:
+				out.append('%s{%s}' % (head, inner))
+		elif head.startswith('@'):
+			# @font-face, @keyframes, @page, @-ms-viewport
+			out.append('%s{%s}' % (head, body))
+		else:
+			selectors = [s for s in head.split(',') if keepselector(s, classes)]
+			if selectors:
+				out.append('%s{%s}' % (','.join(selectors), body))
+	return ''.join(out)
+
+def writefile(path, data):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, 'wb') as out:
+		out.write(data)
+
+def build(static=STATIC_DIR, dist=DIST_DIR, templates=TEMPLATES_DIR):
+	'''
+	Rebuild dist from the ASSETS in static. Returns the manifest and the
+	(source bytes, built bytes, gzip bytes, brotli bytes) of each asset.
+	'''
+	if os.path.isdir(dist):
+		shutil.rmtree(dist)
+	classes = usedclasses(templates)
+	manifest = {}
+	sizes = {}
+	for name in ASSETS:
+		with open(os.path.join(static, name), 'rb') as source:
+			data = source.read()
+		size = len(data)
+		# the maps are not published
+		if name.endswith('.css'):
+			data = SOURCEMAP_CSS.sub('', data.decode('utf-8')).encode('utf-8')
+		elif name.endswith('.js'):
+			data = SOURCEMAP_JS.sub('', data.decode('utf-8')).encode('utf-8')
+		if name in PURGE:
+			data = purgecss(data.decode('utf-8'), classes).encode('utf-8')
+		built = fingerprint(name, data)
+		path = os.path.join(dist, built)
+		writefile(path, data)
+		gzsize = brsize = None
+		if name.endswith(COMPRESS) and len(data) >= COMPRESS_MIN_SIZE:
+			gzdata = gzip.compress(data, 9)
+			if len(gzdata) < len(data):
+				writefile(path + '.gz', gzdata)
+				gzsize = len(gzdata)
+			if brotli is not None:
+				brdata = brotli.compress(data, quality=11)
+				if len(brdata) < len(data):
+					writefile(path + '.br', brdata)
+					brsize = len(brdata)
+		manifest[name] = built
+		sizes[name] = (size, len(data), gzsize, brsize)
+	with open(os.path.join(dist, MANIFEST), 'w') as out:
+		json.dump(manifest, out, indent=1, sort_keys=True)
+	return manifest, sizes
+
+class Assets:
+	"""
+	Built files of a dist directory, as listed in its manifest. Without a
+	build, asset_url() falls back to the plain files under Static/.
+	"""
+
+	def __init__(self, dist=DIST_DIR):
+		self.dist = dist
+		self.manifest = {}
+		# built name -> encodings it has a precompressed copy in
+		self.encodings = {}
+		try:
+			with open(os.path.join(dist, MANIFEST)) as manifest:
+				self.manifest = json.load(manifest)
+		except (IOError, ValueError):
+			return
+		for built in self.manifest.values():
+			path = os.path.join(dist, built)
+			self.encodings[built] = [encoding for encoding, ext in (('br', '.br'), ('gzip', '.gz'))
+				if os.path.exists(path + ext)]
+
+	def built(self, name):
+		return self.manifest.get(name)
+
+	def variant(self, built, accepted):
+		# file to send for built and the Content-Encoding it needs, best compression first
+		for encoding in self.encodings.get(built, ()):
+			if encoding in accepted:
+				return built + ('.br' if encoding == 'br' else '.gz'), encoding
+		return built, None
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""
+Latency and error metrics of roombot commands and IQs, shipped to Graphite
+and served in the Prometheus text format.
+"""
+
+import contextlib
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from rttprobe import percentile
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# kind of series -> (Prometheus label, help text)
+KINDS = {
+    'command': ('command', "Time spent handling groupchat commands."),
+    'iq': ('iq', "Time spent waiting for IQ answers from the server."),
+}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Series(object):
+
+    """
+    Counters and latency histogram of one command or IQ type since
+    start, and the latencies seen since the last Graphite flush.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+        self.window = []
+        self.window_errors = 0
+
+    def observe(self, seconds, ok):
+        self.count += 1
+        self.sum += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        if not ok:
+            self.errors += 1
+            self.window_errors += 1
+        self.window.append(seconds)
+
+
+class BotMetrics(object):
+
+    """
+    Registry of per command and per IQ type series.
+
+    flush() emits <prefix>.<kind>.<name>.count, .errors, .p50, .p95 and
+    .max for the latencies seen since the previous flush. render() and
+    the serve() endpoint give the totals since start as Prometheus
+    histograms and counters.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        # (kind, name) -> Series
+        self.series = {}
+        # metric name -> callable returning its current value
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def observe(self, kind, name, seconds, ok=True):
+        with self.lock:
+            series = self.series.get((kind, name))
+            if series is None:
+                series = self.series[(kind, name)] = Series()
+            series.observe(seconds, ok)
+
+    @contextlib.contextmanager
+    def timed(self, kind, name):
+        start = time.time()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.observe(kind, name, time.time() - start, ok)
+
+    def wrap(self, kind, name, func):
+        '''
+        Timed version of func; raising or returning False counts as an error.
+        '''
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.time()
+            ok = False
+            try:
+                result = func(*args, **kwargs)
+                ok = result is not False
+                return result
+            finally:
+                self.observe(kind, name, time.time() - start, ok)
+        return timed
+
+    def instrument(self, obj, kind, names):
+        '''
+        Replace the methods names of obj with timed versions.
+        '''
+        for name in names:
+            setattr(obj, name, self.wrap(kind, name, getattr(obj, name)))
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def flush(self, emit):
+        ts = int(time.time())
+        with self.lock:
+            windows = []
+            for (kind, name), series in self.series.items():
+                if series.window:
+                    windows.append((kind, name, sorted(series.window), series.window_errors))
+                series.window = []
+                series.window_errors = 0
+
+        for kind, name, samples, errors in windows:
+            base = "%s.%s.%s" % (self.prefix, kind, name.lstrip('!').replace('-', '_'))
+            emit(base + '.count', len(samples), ts)
+            emit(base + '.errors', errors, ts)
+            emit(base + '.p50', percentile(samples, 50), ts)
+            emit(base + '.p95', percentile(samples, 95), ts)
+            emit(base + '.max', samples[-1], ts)
+
+    def render(self):
+        with self.lock:
+            series = sorted((kind, name, list(s.buckets), s.count, s.errors, s.sum)
+                            for (kind, name), s in self.series.items())
+
+        lines = []
+        for kind, (label, helptext) in sorted(KINDS.items()):
+            rows = [row for row in series if row[0] == kind]
+            if not rows:
+                continue
+            metric = "roombot_%s_seconds" % kind
+            lines.append("# HELP %s %s" % (metric, helptext))
+            lines.append("# TYPE %s histogram" % metric)
+            for _, name, buckets, count, errors, total in rows:
+                cumulative = 0
+                for bound, hits in zip(BUCKETS, buckets):
+                    cumulative += hits
+                    lines.append('%s_bucket{%s="%s",le="%s"} %d' % (metric, label, name, bound, cumulative))
+                lines.append('%s_bucket{%s="%s",le="+Inf"} %d' % (metric, label, name, count))
+                lines.append('%s_sum{%s="%s"} %f' % (metric, label, name, total))
+                lines.append('%s_count{%s="%s"} %d' % (metric, label, name, count))
+
+            lines.append("# TYPE roombot_%s_errors_total counter" % kind)
+            for _, name, buckets, count, errors, total in rows:
+                lines.append('roombot_%s_errors_total{%s="%s"} %d' % (kind, label, name, errors))
+
+        for name, value in sorted(self.gauges.items()):
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %s" % (name, value()))
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host, port):
+        '''
+        Serve render() at http://host:port/metrics from a daemon thread.
+        '''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes are not worth a log line each
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name="metrics-http")
+        thread.daemon = True
+        thread.start()
+        return server
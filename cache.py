@@ -0,0 +1,164 @@
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+import time
+
+
+class Snapshot:
+	"""
+	In-memory copy of an expensive query result.
+
+	The first get() loads the value and starts a background thread that
+	reloads it every `ttl` seconds, so readers are served from memory and
+	the database sees one load per interval however many readers there
+	are. If the refresher falls behind, readers keep getting the last good
+	value (stale-while-revalidate) until it is older than `maxstale`, at
+	which point get() reloads synchronously.
+
+	`digest` fingerprints the current value and only changes when the
+	data does, so it can be used as an ETag. snapshot() returns the value
+	and its digest as one pair; reading them separately can mix a value
+	with the digest of the load after it.
+	"""
+
+	def __init__(self, loader, ttl=30.0, maxstale=300.0, name='snapshot'):
+		self.loader = loader
+		self.ttl = ttl
+		self.maxstale = maxstale
+		self.name = name
+		# (value, digest), replaced as a whole by each load
+		self.current = (None, None)
+		self.loaded = 0.0
+		self.loadlock = threading.Lock()
+		self.startlock = threading.Lock()
+		self.pid = None
+
+	@property
+	def value(self):
+		return self.current[0]
+
+	@property
+	def digest(self):
+		return self.current[1]
+
+	def snapshot(self):
+		self.start()
+		current = self.current
+		if current[0] is None or time.time() - self.loaded > self.maxstale:
+			self.refresh()
+			current = self.current
+		return current
+
+	def get(self):
+		return self.snapshot()[0]
+
+	def age(self):
+		return time.time() - self.loaded
+
+	def refresh(self):
+		# single flight: callers that queued behind a load reuse its result
+		with self.loadlock:
+			if self.value is not None and self.age() < self.ttl:
+				return
+			value = self.loader()
+			self.current = (value, hashlib.md5(repr(value).encode('utf-8')).hexdigest())
+			self.loaded = time.time()
+
+	def start(self):
+		# the refresher is per process, a forked worker starts its own
+		if self.pid == os.getpid():
+			return
+		with self.startlock:
+			if self.pid == os.getpid():
+				return
+			self.pid = os.getpid()
+			thread = threading.Thread(target=self.run, name='%s-refresh' % self.name)
+			thread.daemon = True
+			thread.start()
+
+	def run(self):
+		while True:
+			wait = self.ttl - self.age() if self.value is not None else self.ttl
+			time.sleep(max(wait, 1.0))
+			try:
+				self.refresh()
+			except Exception as err:
+				print('%s: refresh failed, serving cached copy: %s' % (self.name, err))
+
+
+class LRUCache:
+	"""
+	Thread safe mapping holding at most `maxsize` entries; the least
+	recently used entry is dropped to make room for a new one.
+
+	load() fills misses single flight: concurrent callers missing the same
+	key wait for the first one's loader instead of each running their own.
+	"""
+
+	def __init__(self, maxsize=1024):
+		self.maxsize = maxsize
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		# key -> [lock held while loading it, number of callers using the lock]
+		self.loading = {}
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, default=None):
+		with self.lock:
+			try:
+				value = self.entries[key]
+			except KeyError:
+				self.misses += 1
+				return default
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return value
+
+	def put(self, key, value):
+		with self.lock:
+			self.entries[key] = value
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+
+	def load(self, key, loader, fresh=None):
+		'''
+		Cached value of key, or loader()'s result stored under key when
+		there is none or fresh(value) is false.
+		'''
+		# a stale entry counts as a miss, not as a hit followed by a load
+		with self.lock:
+			value = self.entries.get(key)
+		if value is not None and (fresh is None or fresh(value)):
+			with self.lock:
+				if key in self.entries:
+					self.entries.move_to_end(key)
+				self.hits += 1
+			return value
+		with self.lock:
+			self.misses += 1
+			entry = self.loading.get(key)
+			if entry is None:
+				entry = self.loading[key] = [threading.Lock(), 0]
+			entry[1] += 1
+		try:
+			with entry[0]:
+				# loaded by whoever held the lock before us
+				with self.lock:
+					value = self.entries.get(key)
+				if value is not None and (fresh is None or fresh(value)):
+					return value
+				value = loader()
+				self.put(key, value)
+				return value
+		finally:
+			with self.lock:
+				entry[1] -= 1
+				if not entry[1]:
+					del self.loading[key]
+
+	def stats(self):
+		with self.lock:
+			return {'size': len(self.entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,88 @@
+from collections import deque
+import os
+import threading
+import time
+
+
+class Feed:
+	"""
+	Change events computed once and shared by any number of readers.
+
+	A background thread calls `source()` every `interval` seconds. It
+	returns a (version, state) pair, and whenever the version moves,
+	`diff(oldstate, newstate)` turns the two states into a list of
+	events. Each non-empty list is stored under the next sequence number,
+	and waiting readers are woken. Readers only ever look at the stored
+	lists, so the cost of a change does not grow with their number.
+
+	The last `backlog` lists are kept so that a reader that reconnects
+	with the last sequence number it saw can pick up where it left off.
+	"""
+
+	def __init__(self, source, diff, interval=5.0, backlog=100, name='feed'):
+		self.source = source
+		self.diff = diff
+		self.interval = interval
+		self.name = name
+		self.events = deque(maxlen=backlog)
+		self.seq = 0
+		self.version = None
+		self.state = None
+		self.cond = threading.Condition()
+		self.startlock = threading.Lock()
+		self.pid = None
+		# tells this process's sequence numbers apart from another's
+		self.epoch = None
+
+	def start(self):
+		# one poller per process, like Snapshot's refresher
+		if self.pid == os.getpid():
+			return
+		with self.startlock:
+			if self.pid == os.getpid():
+				return
+			self.pid = os.getpid()
+			self.epoch = '%x%x' % (self.pid, int(time.time()))
+			thread = threading.Thread(target=self.run, name='%s-poll' % self.name)
+			thread.daemon = True
+			thread.start()
+
+	def run(self):
+		while True:
+			try:
+				self.poll()
+			except Exception as err:
+				print('%s: poll failed: %s' % (self.name, err))
+			time.sleep(self.interval)
+
+	def poll(self):
+		version, state = self.source()
+		if version == self.version:
+			return
+		events = self.diff(self.state, state) if self.state is not None else []
+		with self.cond:
+			self.version = version
+			self.state = state
+			if events:
+				self.seq += 1
+				self.events.append((self.seq, events))
+				self.cond.notify_all()
+
+	def current(self):
+		with self.cond:
+			return self.seq
+
+	def wait(self, after, timeout):
+		'''
+		Event lists stored after sequence number `after` as (seq, events)
+		pairs, waiting up to `timeout` seconds for one to arrive. Returns
+		an empty list on timeout and None when some of the lists after
+		`after` are no longer kept.
+		'''
+		self.start()
+		with self.cond:
+			if self.seq <= after:
+				self.cond.wait(timeout)
+			if self.seq > after and (not self.events or self.events[0][0] > after + 1):
+				return None
+			return [entry for entry in self.events if entry[0] > after]
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""
+Buffered Graphite (carbon) metric emitter used by roombot.
+"""
+
+import collections
+import logging
+import pickle
+import socket
+import struct
+import threading
+import time
+
+PROTOCOLS = ('plaintext', 'pickle', 'udp')
+
+# keep datagrams under a typical MTU
+UDP_PAYLOAD = 1400
+
+log = logging.getLogger(__name__)
+
+
+class GraphiteSender(object):
+
+    """
+    Ships metrics to carbon from a background thread.
+
+    send() only appends to a bounded in-memory queue, so it never blocks
+    the caller on the network. The sender thread flushes the queue in
+    batches of batch_size, or every flush_interval seconds if fewer are
+    waiting, over one persistent connection that is re-established with
+    exponential backoff when it breaks. When the queue is full the oldest
+    metrics are dropped.
+
+    protocol is one of:
+      plaintext -- "path value timestamp" lines over TCP (carbon line receiver)
+      pickle    -- length-prefixed pickled batches over TCP (carbon pickle receiver)
+      udp       -- plaintext lines in datagrams, fire and forget
+    """
+
+    def __init__(self, addr, protocol='plaintext', batch_size=100,
+                 flush_interval=5, queue_size=10000, timeout=2, max_backoff=60):
+        if protocol not in PROTOCOLS:
+            raise ValueError("unknown graphite protocol %s" % protocol)
+
+        self.addr = addr
+        self.protocol = protocol
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+
+        self.queue = collections.deque(maxlen=queue_size)
+        self.cond = threading.Condition()
+        self.sock = None
+        self.backoff = 0
+        self.retry_at = 0
+        self.running = True
+
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+
+        self.thread = threading.Thread(target=self.run, name="graphite-sender")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, metric, value, ts=None):
+        if ts is None:
+            ts = int(time.time())
+
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append((metric, ts, value))
+            if len(self.queue) >= self.batch_size:
+                self.cond.notify()
+
+    def close(self, timeout=5):
+        '''
+        Flush what is queued and stop the sender thread.
+        '''
+        with self.cond:
+            self.running = False
+            self.retry_at = 0
+            self.cond.notify()
+        self.thread.join(timeout)
+        self.disconnect()
+
+    def stats(self):
+        with self.cond:
+            return {'queued': len(self.queue), 'sent': self.sent,
+                    'dropped': self.dropped, 'errors': self.errors}
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.running and not self.queue:
+                    return
+
+                delay = self.retry_at - time.time()
+                if delay > 0 and self.running:
+                    self.cond.wait(delay)
+                    continue
+
+                if self.running and len(self.queue) < self.batch_size:
+                    self.cond.wait(self.flush_interval)
+
+                count = min(len(self.queue), self.batch_size)
+                batch = [self.queue.popleft() for i in range(count)]
+
+            if batch and not self.flush(batch) and not self.running:
+                # shutting down with the carbon side unreachable
+                return
+
+    def flush(self, batch):
+        try:
+            self.write(batch)
+        except (socket.error, OSError) as err:
+            self.disconnect()
+            self.backoff = min(max(self.backoff * 2, 1), self.max_backoff)
+            log.warning("Error sending metrics, retrying in %ds: %s", self.backoff, err)
+            with self.cond:
+                self.errors += 1
+                self.retry_at = time.time() + self.backoff
+                self.requeue(batch)
+            return False
+
+        self.backoff = 0
+        with self.cond:
+            self.sent += len(batch)
+        return True
+
+    def requeue(self, batch):
+        # put a failed batch back in front of the queue, keeping only as
+        # much as fits so that the oldest metrics are the ones dropped.
+        room = self.queue.maxlen - len(self.queue)
+        keep = batch[len(batch) - room:] if room < len(batch) else batch
+        self.dropped += len(batch) - len(keep)
+        self.queue.extendleft(reversed(keep))
+
+    def write(self, batch):
+        if self.protocol == 'pickle':
+            payload = pickle.dumps([(metric, (ts, value)) for metric, ts, value in batch], protocol=2)
+            self.connection().sendall(struct.pack('!L', len(payload)) + payload)
+            return
+
+        lines = [u'{} {} {}\n'.format(metric, str(value), str(ts)).encode('utf-8')
+                 for metric, ts, value in batch]
+
+        if self.protocol == 'udp':
+            sock = self.connection()
+            datagram = b''
+            for line in lines:
+                if datagram and len(datagram) + len(line) > UDP_PAYLOAD:
+                    sock.sendto(datagram, self.addr)
+                    datagram = b''
+                datagram += line
+            if datagram:
+                sock.sendto(datagram, self.addr)
+            return
+
+        self.connection().sendall(b''.join(lines))
+
+    def connection(self):
+        if self.sock is None:
+            if self.protocol == 'udp':
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            else:
+                self.sock = socket.create_connection(self.addr, self.timeout)
+        return self.sock
+
+    def disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except (socket.error, OSError):
+                pass
+            self.sock = None
@@ -0,0 +1,44 @@
+# gunicorn settings for the dashboard, see the Serving section of README.md.
+# Every value can be overridden from the environment, e.g. JSAT_WORKERS=8
+import multiprocessing
+import os
+
+import queries
+import settings
+
+bind = os.environ.get('JSAT_BIND', '0.0.0.0:8080')
+
+# one process per core, each running threads. An open /rooms/stream holds
+# a thread, at most [stream] maxstreams (8) of them per worker, so keep
+# threads above that for page and API requests
+workers = int(os.environ.get('JSAT_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('JSAT_THREADS', 16))
+
+# keep connections from browsers and pollers open between requests
+keepalive = int(os.environ.get('JSAT_KEEPALIVE', 5))
+# streams end after [stream] maxage and reconnect; gthread workers
+# heartbeat from their main loop, so this only catches hung workers
+timeout = int(os.environ.get('JSAT_TIMEOUT', 60))
+# seconds busy workers get to finish on HUP (reload) or TERM
+graceful_timeout = int(os.environ.get('JSAT_GRACEFUL_TIMEOUT', 30))
+
+# recycle workers now and then, jittered so they don't restart together
+max_requests = int(os.environ.get('JSAT_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+# import app.py, read database.ini and compile the templates once in the
+# master. `kill -HUP <master pid>` starts new workers on the loaded code and
+# stops the old ones gracefully; restart the master to pick up code changes
+preload_app = True
+
+accesslog = os.environ.get('JSAT_ACCESSLOG', '-')
+
+def pre_fork(server, worker):
+	# connections opened in the master must not be shared with the workers
+	settings.closepool()
+
+def post_fork(server, worker):
+	# each worker opens its own pool on first use and prepares statements on it
+	with queries.preparedlock:
+		queries.prepared.clear()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""
+Repeating jobs on a SleekXMPP scheduler that can be replaced at runtime.
+"""
+
+import itertools
+import threading
+
+
+class RepeatingJobs(object):
+
+    """
+    Named jobs run every `seconds` on scheduler, each as a chain of
+    one-shot tasks where every run adds the next one.
+
+    The scheduler can't replace a repeating task reliably: remove()
+    misses tasks still waiting on its add queue, and add() refuses a
+    name it already holds. Here every task gets a name of its own, and
+    set() or cancel() only move the job to a new generation; a pending
+    task of an older generation does nothing when it fires and ends its
+    chain.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        # job name -> current generation
+        self.generations = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def set(self, name, seconds, callback, args=None):
+        '''
+        Run callback(*args) every seconds under name, replacing the job
+        of that name if there is one.
+        '''
+        with self.lock:
+            generation = self.generations[name] = self.generations.get(name, 0) + 1
+        self.add(name, generation, seconds, callback, args or ())
+
+    def cancel(self, name):
+        with self.lock:
+            if name in self.generations:
+                self.generations[name] += 1
+
+    def current(self, name, generation):
+        with self.lock:
+            return self.generations.get(name) == generation
+
+    def add(self, name, generation, seconds, callback, args):
+        def run():
+            if not self.current(name, generation):
+                return
+            try:
+                callback(*args)
+            finally:
+                if self.current(name, generation):
+                    self.add(name, generation, seconds, callback, args)
+
+        self.scheduler.add("%s #%d" % (name, next(self.ids)), seconds=seconds, callback=run)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+Logging setup for roombot: records are handed to a queue on the calling
+thread and formatted and written by a background listener.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+# fields passed with extra={...} that end up in the JSON records
+FIELDS = ('command', 'room', 'latency', 'outcome', 'shard')
+
+# SleekXMPP logs every stanza sent and received at DEBUG level from these
+STANZA_LOGGERS = ('sleekxmpp.xmlstream',)
+
+listener = None
+
+
+class JSONFormatter(logging.Formatter):
+
+    """
+    One JSON object per line: time, level, logger and message, plus any
+    of FIELDS set on the record and the traceback if there is one.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) +
+                    '.%03dZ' % record.msecs,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+
+    """
+    Queues records with their message and traceback rendered to text but
+    otherwise unformatted, so the listener's formatter still sees the
+    level, logger and extra fields.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SampleFilter(logging.Filter):
+
+    """
+    Lets through one in every 1/rate DEBUG records of the stanza
+    loggers; anything above DEBUG and other loggers always pass.
+    """
+
+    def __init__(self, rate, loggers=STANZA_LOGGERS):
+        logging.Filter.__init__(self)
+        self.every = max(1, int(round(1.0 / rate))) if rate > 0 else 0
+        self.loggers = loggers
+        self.seen = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or not record.name.startswith(self.loggers):
+            return True
+        if not self.every:
+            return False
+        self.seen += 1
+        return self.seen % self.every == 0
+
+
+class ContextFilter(logging.Filter):
+
+    """
+    Sets the same fields, e.g. the shard number, on every record.
+    """
+
+    def __init__(self, context):
+        logging.Filter.__init__(self)
+        self.context = context
+
+    def filter(self, record):
+        for field, value in self.context.items():
+            setattr(record, field, value)
+        return True
+
+
+def setup(level='INFO', fmt='json', stanza_sample=0.01, stream=None, context=None):
+    '''
+    Route all logging through a queue to one stream handler, replacing
+    whatever handlers the root logger had. Safe to call again, e.g. in a
+    forked shard process, which needs its own listener thread. context
+    holds fields set on every record.
+    '''
+    global listener
+
+    if listener is not None:
+        listener.stop()
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if fmt == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(name)s %(message)s'))
+
+    records = queue.Queue(-1)
+    queued = RecordQueueHandler(records)
+    # drop sampled out stanzas before they cost a queue slot
+    queued.addFilter(SampleFilter(stanza_sample))
+    if context:
+        queued.addFilter(ContextFilter(context))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(queued)
+    set_level(level)
+
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    return listener
+
+
+def set_level(level):
+    logging.getLogger().setLevel(getattr(logging, str(level).upper(), logging.INFO))
+
+
+@atexit.register
+def shutdown():
+    if listener is not None:
+        listener.stop()
@@ -0,0 +1,171 @@
+import hashlib
+import threading
+import time
+import psycopg2
+from psycopg2.errorcodes import DUPLICATE_PREPARED_STATEMENT, UNDEFINED_TABLE
+
+# Every statement runs as a server side prepared statement: it is parsed and
+# planned once per pooled connection, then only EXECUTEd with bound values.
+
+ROOMS_SQL = "select A.room_jid, A.creator_jid, A.subject, A.type, COALESCE(B.rocc,0) from tc_rooms A left join (select room_jid, count(room_jid) as rocc from tc_users where role != 'none' and role != 'mnone' group by room_jid) B on A.room_jid = B.room_jid order by B.rocc desc NULLS LAST"
+
+# with the occupancy index enabled the counts come from memory
+ROOMS_NOCOUNT_SQL = "select room_jid, creator_jid, subject, type, 0 from tc_rooms order by room_jid"
+
+# page of rooms ordered by name or subject, occupancy counted for the page rows only.
+# see sql/rooms_indexes.sql for the indexes behind the search and keyset predicates
+ROOMS_PAGE_SQL = "select A.room_jid, A.creator_jid, A.subject, A.type, (select count(*) from tc_users B where B.room_jid = A.room_jid and B.role != 'none' and B.role != 'mnone') from tc_rooms A"
+ROOMS_PAGE_NOCOUNT_SQL = "select A.room_jid, A.creator_jid, A.subject, A.type, 0 from tc_rooms A"
+
+OCCUPANT_COLUMNS = ('room_jid', 'real_jid', 'role', 'affiliation', 'nick_jid')
+
+OCCUPANTS_SQL = "select room_jid, real_jid, role, affiliation, nick_jid from tc_users where room_jid = %s and role != 'none' and role != 'mnone' order by role desc"
+
+OCCUPANCY_SQL = "select room_jid, real_jid, role, affiliation, nick_jid from tc_users where role != 'none' and role != 'mnone' order by room_jid, role desc"
+
+# message counts come from the trigger maintained jsat_room_msgcount table (sql/msgcount.sql).
+# the occupancy of the one room is counted through the tc_users room_jid index
+ROOMDETAILS_SQL = "select A.room_jid, A.creator_jid, A.subject, A.config, COALESCE(C.msgs,0), (select count(*) from tc_users B where B.room_jid = A.room_jid and B.role != 'none' and B.role != 'mnone') from tc_rooms A left join jsat_room_msgcount C on A.room_jid = C.room_jid where A.room_jid = %s"
+
+# used until the counter table is installed; counts the room's archive on every view
+ROOMDETAILS_LEGACY_SQL = "select A.room_jid, A.creator_jid, A.subject, A.config, (select count(*) from tc_msgarchive C where C.to_jid = A.room_jid), (select count(*) from tc_users B where B.room_jid = A.room_jid and B.role != 'none' and B.role != 'mnone') from tc_rooms A where A.room_jid = %s"
+
+# what the api's roomdetails etag is made of: primary key lookups and the
+# hash of the config instead of the config
+ROOMVERSION_SQL = "select md5(coalesce(A.config, '')), A.creator_jid, A.subject, COALESCE(C.msgs,0), (select count(*) from tc_users B where B.room_jid = A.room_jid and B.role != 'none' and B.role != 'mnone') from tc_rooms A left join jsat_room_msgcount C on A.room_jid = C.room_jid where A.room_jid = %s"
+
+# with the occupancy index enabled the room's occupancy comes from memory
+ROOMDETAILS_NOCOUNT_SQL = "select A.room_jid, A.creator_jid, A.subject, A.config, COALESCE(C.msgs,0), 0 from tc_rooms A left join jsat_room_msgcount C on A.room_jid = C.room_jid where A.room_jid = %s"
+ROOMDETAILS_LEGACY_NOCOUNT_SQL = "select A.room_jid, A.creator_jid, A.subject, A.config, (select count(*) from tc_msgarchive C where C.to_jid = A.room_jid), 0 from tc_rooms A where A.room_jid = %s"
+ROOMVERSION_NOCOUNT_SQL = "select md5(coalesce(A.config, '')), A.creator_jid, A.subject, COALESCE(C.msgs,0), 0 from tc_rooms A left join jsat_room_msgcount C on A.room_jid = C.room_jid where A.room_jid = %s"
+
+# when jsat_room_msgcount was last found missing, 0 while it is in use.
+# it is looked for again every MSGCOUNT_RETRY seconds, so installing it
+# takes effect without a restart
+msgcountmissing = 0.0
+MSGCOUNT_RETRY = 300.0
+
+def msgcounttable():
+	return not msgcountmissing or time.time() - msgcountmissing > MSGCOUNT_RETRY
+
+# (connection id, backend pid) -> names of the statements prepared on it.
+# entries of closed connections are never matched again and stay small
+prepared = {}
+preparedlock = threading.Lock()
+
+def statementname(sql):
+	return 'jsat_' + hashlib.md5(sql.encode('utf-8')).hexdigest()[:16]
+
+def numbered(sql):
+	# %s placeholders to the $1, $2, ... of PREPARE
+	parts = sql.split('%s')
+	text = parts[0]
+	for n, part in enumerate(parts[1:], 1):
+		text += '$%d' % n + part
+	return text
+
+def execute(cursor, sql, params=()):
+	# run sql with %s placeholders as a prepared statement on the cursor's connection
+	con = cursor.connection
+	key = (id(con), con.get_backend_pid())
+	name = statementname(sql)
+	with preparedlock:
+		names = prepared.setdefault(key, set())
+		ready = name in names
+	if not ready:
+		try:
+			cursor.execute('prepare %s as %s' % (name, numbered(sql)))
+		except psycopg2.ProgrammingError as err:
+			# prepared before we started tracking this connection
+			if err.pgcode != DUPLICATE_PREPARED_STATEMENT:
+				raise
+			con.rollback()
+		with preparedlock:
+			names.add(name)
+	if params:
+		cursor.execute('execute %s (%s)' % (name, ', '.join(['%s'] * len(params))), params)
+	else:
+		cursor.execute('execute %s' % name)
+
+def fetchrooms(cursor, counts=True):
+	execute(cursor, ROOMS_SQL if counts else ROOMS_NOCOUNT_SQL)
+	return cursor.fetchall()
+
+def likepattern(q):
+	return '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def fetchroompage(cursor, q, sort, limit, after, counts=True):
+	# one statement per combination of search, sort and cursor, 8 in all
+	conditions = []
+	params = []
+	if q:
+		conditions.append("(A.room_jid ilike %s or A.subject ilike %s)")
+		params += [likepattern(q), likepattern(q)]
+	if sort == 'name':
+		if after:
+			conditions.append("A.room_jid > %s")
+			params.append(str(after[1]))
+		order = "A.room_jid"
+	else:
+		if after:
+			conditions.append("(coalesce(A.subject, ''), A.room_jid) > (%s::text, %s::text)")
+			params += [str(after[0] or ''), str(after[1])]
+		order = "coalesce(A.subject, ''), A.room_jid"
+
+	sql = ROOMS_PAGE_SQL if counts else ROOMS_PAGE_NOCOUNT_SQL
+	if conditions:
+		sql += " where " + " and ".join(conditions)
+	sql += " order by %s limit %%s" % order
+	params.append(limit + 1)
+	execute(cursor, sql, params)
+	return cursor.fetchall()
+
+def fetchoccupants(cursor, room):
+	execute(cursor, OCCUPANTS_SQL, (room,))
+	return cursor.fetchall()
+
+def fetchoccupancy(cursor):
+	execute(cursor, OCCUPANCY_SQL)
+	return cursor
+
+def nocounttable(cursor, err):
+	# whether err says jsat_room_msgcount is missing; if so stop using it for a while
+	global msgcountmissing
+	if err.pgcode != UNDEFINED_TABLE:
+		return False
+	cursor.connection.rollback()
+	if not msgcountmissing:
+		print('jsat_room_msgcount is missing, counting tc_msgarchive per view. Run: flask --app app install-msgcount')
+	msgcountmissing = time.time()
+	return True
+
+def countsfound():
+	global msgcountmissing
+	if msgcountmissing:
+		print('jsat_room_msgcount found, no longer counting tc_msgarchive')
+		msgcountmissing = 0.0
+
+def fetchroomdetails(cursor, room, counts=True):
+	if msgcounttable():
+		try:
+			execute(cursor, ROOMDETAILS_SQL if counts else ROOMDETAILS_NOCOUNT_SQL, (room,))
+			countsfound()
+			return cursor.fetchall()
+		except psycopg2.ProgrammingError as err:
+			if not nocounttable(cursor, err):
+				raise
+	execute(cursor, ROOMDETAILS_LEGACY_SQL if counts else ROOMDETAILS_LEGACY_NOCOUNT_SQL, (room,))
+	return cursor.fetchall()
+
+def fetchroomversion(cursor, room, counts=True):
+	# row that changes whenever the room's details do, None without the
+	# counter table as the archive count would cost as much as the details
+	if msgcounttable():
+		try:
+			execute(cursor, ROOMVERSION_SQL if counts else ROOMVERSION_NOCOUNT_SQL, (room,))
+			countsfound()
+			return cursor.fetchone()
+		except psycopg2.ProgrammingError as err:
+			if not nocounttable(cursor, err):
+				raise
+	return None
@@ -11,12 +11,24 @@ requirements:
 
 import time
 import sys
-import traceback
+import threading
+import collections
+import os
+import signal
+import contextlib
+import csv
+import argparse
+import multiprocessing
 import sleekxmpp
 import logging
 import yaml
-import syslog
-import socket
+import logsetup
+from graphite import GraphiteSender
+from rttprobe import ProbeEngine, METRIC_PREFIX
+from botmetrics import BotMetrics
+from sharding import HashRing
+from jobs import RepeatingJobs
+from concurrent.futures import ThreadPoolExecutor
 
 # Python versions before 3.0 do not use UTF-8 encoding
 # by default. To ensure that Unicode is handled properly
@@ -28,36 +40,514 @@ if sys.version_info < (3, 0):
 else:
     raw_input = input
 
-configFile = "/etc/roombot.yaml"
+configFile = os.environ.get('ROOMBOT_CONFIG', "/etc/roombot.yaml")
 configParams = {}
 
-GRAPHITE_ADDR = ('127.0.0.1', int(3002))
-with open(configFile, 'r') as stream:
-    try:
-        configParams = yaml.load(stream)
-    except:
-        print("Unable to read config file: %" % configFile)
-
-SERVER      = configParams['server']
-ALIAS       = configParams['alias']
-JID         = configParams['jid']
-PASS        = configParams['pass']
-MUC         = configParams['muc']
-PING_MUCS   = configParams['ping_mucs']
-DOMAIN      = configParams['domain']
-CONF_DOMAIN = configParams['conf_domain']
-ADMINS      = configParams['admins']
+# keys every config must have
+REQUIRED_KEYS = ('server', 'alias', 'jid', 'pass', 'muc', 'ping_mucs',
+                 'domain', 'conf_domain', 'admins')
+# keys only read while connecting or starting up; a reload warns
+# about changes to them and keeps their running values until a restart
+RESTART_KEYS = ('server', 'alias', 'jid', 'pass', 'muc', 'conf_domain',
+                'workers', 'graphite', 'metrics')
+# logging settings and their defaults
+LOGGING_DEFAULTS = {'level': 'INFO', 'format': 'json', 'stanza_sample': 0.01}
+# command/IQ metrics settings and their defaults; port 0 turns off /metrics
+METRICS_DEFAULTS = {'host': '127.0.0.1', 'port': 9105, 'interval': 60}
+# optional keys holding a positive number of seconds or a count
+NUMBER_KEYS = ('workers', 'bulk_concurrency', 'room_config_ttl', 'affiliation_ttl',
+               'directory_refresh', 'max_joined_rooms', 'room_idle_timeout',
+               'config_poll')
+
+def read_config(path):
+    '''
+    Read the bot config from path and check it, raising ValueError
+    (or yaml.YAMLError / IOError) when it can't be used.
+    '''
+    with open(path, 'r') as stream:
+        params = yaml.safe_load(stream)
+
+    if not isinstance(params, dict):
+        raise ValueError("%s: expected a mapping of settings" % path)
+
+    missing = [key for key in REQUIRED_KEYS if key not in params]
+    if missing:
+        raise ValueError("%s: missing %s" % (path, ", ".join(missing)))
+
+    for key in ('ping_mucs', 'admins'):
+        params[key] = params[key] or []
+        if not isinstance(params[key], list):
+            raise ValueError("%s: %s must be a list" % (path, key))
+
+    for key in NUMBER_KEYS:
+        check_number(path, key, params.get(key))
+
+    for key in ('graphite', 'rtt', 'logging', 'metrics'):
+        if not isinstance(params.get(key) or {}, dict):
+            raise ValueError("%s: %s must be a mapping" % (path, key))
+
+    metrics = params.get('metrics') or {}
+    # a zero interval would have the flush job run back to back
+    check_number(path, 'metrics.interval', metrics.get('interval'))
+    port = metrics.get('port')
+    if port is not None and (isinstance(port, bool) or not isinstance(port, int) or
+                             not 0 <= port < 65536):
+        raise ValueError("%s: metrics.port must be a port number or 0, not %r" % (path, port))
+
+    return params
+
+def check_number(path, key, value):
+    if value is not None and (isinstance(value, bool) or
+                              not isinstance(value, (int, float)) or value <= 0):
+        raise ValueError("%s: %s must be a positive number, not %r" % (path, key, value))
+
+def apply_config(params):
+    '''
+    Make a config returned by read_config() the live one. Every value is
+    worked out before the module settings are swapped.
+    '''
+    global configParams, SERVER, ALIAS, JID, PASS, MUC, PING_MUCS, DOMAIN, \
+        CONF_DOMAIN, ADMINS, WORKERS, BULK_CONCURRENCY, ROOM_CONFIG_TTL, \
+        AFFILIATION_TTL, DIRECTORY_REFRESH, MAX_JOINED_ROOMS, ROOM_IDLE_TIMEOUT, \
+        CONFIG_POLL, GRAPHITE, GRAPHITE_ADDR, RTT, LOGGING, METRICS
+
+    graphite = params.get('graphite') or {}
+    values = (params,
+              params['server'],
+              params['alias'],
+              params['jid'],
+              params['pass'],
+              params['muc'],
+              params['ping_mucs'],
+              params['domain'],
+              params['conf_domain'],
+              params['admins'],
+              params.get('workers', 4),
+              params.get('bulk_concurrency', 8),
+              params.get('room_config_ttl', 3600),
+              params.get('affiliation_ttl', 600),
+              params.get('directory_refresh', 300),
+              params.get('max_joined_rooms', 20),
+              params.get('room_idle_timeout', 300),
+              params.get('config_poll', 5),
+              graphite,
+              (graphite.get('host', '127.0.0.1'), int(graphite.get('port', 3002))),
+              params.get('rtt') or {},
+              dict(LOGGING_DEFAULTS, **(params.get('logging') or {})),
+              dict(METRICS_DEFAULTS, **(params.get('metrics') or {})))
+
+    (configParams, SERVER, ALIAS, JID, PASS, MUC, PING_MUCS, DOMAIN,
+     CONF_DOMAIN, ADMINS, WORKERS, BULK_CONCURRENCY, ROOM_CONFIG_TTL,
+     AFFILIATION_TTL, DIRECTORY_REFRESH, MAX_JOINED_ROOMS, ROOM_IDLE_TIMEOUT,
+     CONFIG_POLL, GRAPHITE, GRAPHITE_ADDR, RTT, LOGGING, METRICS) = values
+
+try:
+    apply_config(read_config(configFile))
+except (IOError, ValueError, yaml.YAMLError) as err:
+    sys.exit("Unable to read config file %s: %s" % (configFile, err))
+
+log = logging.getLogger('roombot')
+
 HELP_MSG    = 'Usage: !make-room <roomname> [owner=user.name]'
-CMDS        = { 
-                 '!make-room'   : "Add a new groupchat.", 
-                 '!destroy-room': "Delete a groupchat. (Admin users only)",
-                 '!set-owner'   : "Set an owner for a groupchat.",
-                 '!drop-owner'  : "Unset groupchat owner - lowers affiliation to member.",
-                 '!set-admin'   : "Set an admin for a groupchat.",
-                 '!drop-admin'  : "Unset groupchat admin - lowers affiliation to member.",
-                 '!kick-alias'   : "Kick an alias from the given groupchat. (requires the user Handle/Alias not JID)",
-                 '!help'        : "This msg.",
-               }
+
+# command name -> help text and command name -> handler, filled in by @command
+CMDS        = {}
+COMMANDS    = {}
+# commands taking a list of rooms, run by every shard that owns one of them
+MULTIROOM_COMMANDS = set()
+
+Command = collections.namedtuple('Command', ['name', 'room', 'args', 'rest'])
+
+def command(name, helptext, multiroom=False):
+    '''
+    Register a MUCBot method as the handler of a groupchat command.
+    Handlers are called as handler(bot, msg, cmd).
+    '''
+    def register(handler):
+        CMDS[name] = helptext
+        COMMANDS[name] = handler
+        if multiroom:
+            MULTIROOM_COMMANDS.add(name)
+        return handler
+    return register
+
+def parse_command(body):
+    '''
+    Parse a "!name <room> key=value ..." message body once into a Command:
+      name -- the first token, e.g. !set-owner
+      room -- the second token with @CONF_DOMAIN appended if missing, or ''
+      args -- dict of the key=value tokens after the room
+      rest -- everything after the room, unsplit
+    '''
+    tokens = body.split(' ')
+
+    room = tokens[1].strip() if len(tokens) > 1 else ''
+    if room:
+        room = room_jid(room)
+
+    args = {}
+    for token in tokens[2:]:
+        key, sep, value = token.partition('=')
+        if sep:
+            args[key] = value.strip()
+
+    rest = body.split(' ', 2)[2] if len(tokens) > 2 else ''
+
+    return Command(tokens[0], room, args, rest)
+
+def bulk_summary(title, results):
+    failed = [(room, reply) for room, ok, reply in results if not ok]
+    summary = "%s: %d of %d rooms done." % (title, len(results) - len(failed), len(results))
+    for room, ok, reply in results:
+        summary += "\n%s %s" % ("OK  " if ok else "FAIL", reply)
+    return summary
+
+def form_value(value):
+    '''
+    Normalise a data form value for comparison: booleans become '1'/'0'.
+    '''
+    if value is True or value in ('true', 'True'):
+        return '1'
+    if value is False or value in ('false', 'False'):
+        return '0'
+    if isinstance(value, list):
+        return tuple(value)
+    if value is None:
+        return ''
+    return str(value)
+
+def room_jid(room):
+    domainpart = '@' + CONF_DOMAIN
+    if domainpart not in room:
+        room += domainpart
+    return room
+
+def room_list(body):
+    '''
+    Room jids named in a bulk command body, e.g.
+      !make-rooms room1,room2 room3 owner=foo.bar
+    returns [room1@conf, room2@conf, room3@conf].
+    '''
+    rooms = []
+    for token in body.replace(',', ' ').split()[1:]:
+        if '=' in token:
+            continue
+        room = room_jid(token)
+        if room not in rooms:
+            rooms.append(room)
+    return rooms
+
+def load_bulk_file(path):
+    '''
+    Read (room, owner) pairs for --bulk from a YAML file, either a list
+    of {room: ..., owner: ...} entries or a room: owner mapping, or from
+    a CSV file with room,owner rows.
+    '''
+    with open(path, 'r') as stream:
+        if path.endswith(('.yaml', '.yml')):
+            entries = yaml.safe_load(stream) or []
+            if isinstance(entries, dict):
+                entries = [{'room': room, 'owner': owner} for room, owner in entries.items()]
+            rows = [(entry.get('room'), entry.get('owner')) for entry in entries]
+        else:
+            rows = [tuple(row[:2]) for row in csv.reader(stream) if row and not row[0].startswith('#')]
+            if rows and rows[0] == ('room', 'owner'):
+                rows = rows[1:]
+
+    jobs = []
+    for row in rows:
+        if len(row) < 2 or not row[0] or not row[1]:
+            raise ValueError("%s: every entry needs a room and an owner: %s" % (path, row))
+        owner = row[1].strip()
+        if '@' + DOMAIN not in owner:
+            owner += '@' + DOMAIN
+        jobs.append((room_jid(row[0].strip()), owner))
+    return jobs
+
+class MUCDirectory(object):
+
+    """
+    In-memory set of the rooms listed by disco#items on the conference
+    domain, so room lookups don't cost a full disco walk each.
+    """
+
+    def __init__(self, xmpp, domain, min_refresh=5):
+        self.xmpp = xmpp
+        self.domain = domain
+        # a miss triggers at most one disco walk per min_refresh seconds
+        self.min_refresh = min_refresh
+        self.rooms = set()
+        self.refreshed = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        results = self.xmpp['xep_0030'].get_items(jid=self.domain, iterator=True)
+        rooms = set(str(muc['jid']).lower() for muc in results['disco_items'])
+        with self.lock:
+            self.rooms = rooms
+            self.refreshed = time.time()
+        return len(rooms)
+
+    def __contains__(self, room):
+        room = room.lower()
+        if room in self.rooms:
+            return True
+        if time.time() - self.refreshed < self.min_refresh:
+            return False
+        self.refresh()
+        return room in self.rooms
+
+    def snapshot(self):
+        with self.lock:
+            return frozenset(self.rooms)
+
+    def add(self, room):
+        with self.lock:
+            self.rooms.add(room.lower())
+
+    def discard(self, room):
+        with self.lock:
+            self.rooms.discard(room.lower())
+
+
+class AffiliationCache(object):
+
+    """
+    Per-room owner/admin/member lists, each fetched from the room the
+    first time it is needed and kept for ttl seconds. The bot records
+    its own affiliation changes and those seen in occupant presence, so
+    the lists stay current without re-querying the server.
+    """
+
+    NS_ADMIN = 'http://jabber.org/protocol/muc#admin'
+
+    def __init__(self, xmpp, ttl):
+        self.xmpp = xmpp
+        self.ttl = ttl
+        # room -> {affiliation: (fetched at, set of bare jids)}
+        self.rooms = {}
+        self.lock = threading.Lock()
+
+    def get(self, room, affiliation):
+        '''
+        Bare jids holding affiliation in room, or None if the list
+        can't be fetched.
+        '''
+        with self.lock:
+            cached = self.rooms.get(room, {}).get(affiliation)
+            if cached is not None and time.time() - cached[0] < self.ttl:
+                return frozenset(cached[1])
+
+        try:
+            result = self.xmpp.plugin['xep_0045'].getUsersByAffiliation(room, affiliation)
+        except:
+            log.exception("Unable to fetch %s list of %s", affiliation, room)
+            return None
+
+        items = result.xml.findall('{%s}query/{%s}item' % (self.NS_ADMIN, self.NS_ADMIN))
+        jids = set(item.get('jid').split('/')[0].lower() for item in items if item.get('jid'))
+
+        with self.lock:
+            self.rooms.setdefault(room, {})[affiliation] = (time.time(), jids)
+        return frozenset(jids)
+
+    def record(self, room, jid, affiliation):
+        jid = jid.split('/')[0].lower()
+        with self.lock:
+            for name, (fetched, jids) in self.rooms.get(room, {}).items():
+                if name == affiliation:
+                    jids.add(jid)
+                else:
+                    jids.discard(jid)
+
+    def forget(self, room):
+        with self.lock:
+            self.rooms.pop(room, None)
+
+
+class OccupantIndex(object):
+
+    """
+    (room, nick) -> bare real jid of the occupants of the rooms the bot
+    is in, kept from their presence so a command sender is looked up
+    without asking the MUC plugin. Nick changes arrive as unavailable
+    presence for the old nick followed by presence for the new one.
+    """
+
+    def __init__(self):
+        self.occupants = {}
+        self.lock = threading.Lock()
+
+    def get(self, room, nick):
+        return self.occupants.get((room, nick))
+
+    def presence(self, pr):
+        room = pr['muc']['room']
+        nick = pr['muc']['nick']
+        jid = pr['muc']['jid']
+        with self.lock:
+            if pr['type'] == 'unavailable':
+                self.occupants.pop((room, nick), None)
+            elif jid and jid.bare:
+                self.occupants[(room, nick)] = jid.bare.lower()
+
+    def forget(self, room):
+        with self.lock:
+            for key in [key for key in self.occupants if key[0] == room]:
+                del self.occupants[key]
+
+    def clear(self):
+        with self.lock:
+            self.occupants.clear()
+
+
+class JoinError(Exception):
+
+    """
+    The bot could not get into a room it needs to be in.
+    """
+
+
+class RoomMemberships(object):
+
+    """
+    Keeps the bot joined to the rooms it recently worked on, so commands
+    against the same room reuse one join instead of a join/leave pair
+    (and the presence broadcasts to every occupant that go with it).
+
+    acquire() joins a room unless the bot is already in it and release()
+    marks it idle again. Idle rooms are left once more than max_rooms are
+    joined, least recently used first, or after idle_timeout seconds
+    without use (see sweep()). Rooms in pinned, like the control room,
+    are never joined or left here.
+
+    The use count of a room and the eviction of idle rooms share one
+    lock, and a room being left is not joined again until the leave has
+    gone out, so a sweep never leaves a room from under a command.
+    """
+
+    def __init__(self, xmpp, max_rooms, idle_timeout, pinned=()):
+        self.xmpp = xmpp
+        self.max_rooms = max_rooms
+        self.idle_timeout = idle_timeout
+        self.pinned = set(pinned)
+        # room -> last used, least recently used first; only rooms
+        # joined in this session
+        self.joined = collections.OrderedDict()
+        # room -> number of callers between acquire() and release()
+        self.users = collections.Counter()
+        # rooms taken off joined whose leave hasn't been sent yet
+        self.leaving = set()
+        self.lock = threading.Lock()
+        self.left = threading.Condition(self.lock)
+
+    def acquire(self, room):
+        '''
+        Make sure the bot is in room. Raises JoinError if joining it
+        timed out; the room then counts as neither used nor joined.
+        '''
+        if room in self.pinned:
+            return
+
+        with self.lock:
+            while room in self.leaving:
+                self.left.wait()
+            self.users[room] += 1
+            known = room in self.joined
+
+        ok = False
+        try:
+            # the plugin drops rooms we got kicked from or that were destroyed
+            if known and room in self.xmpp.plugin['xep_0045'].getJoinedRooms():
+                ok = True
+            else:
+                ok = self.xmpp.join_room(room)
+        finally:
+            if not ok:
+                with self.lock:
+                    self.unuse(room)
+                    self.joined.pop(room, None)
+        if not ok:
+            raise JoinError("timed out joining %s" % room)
+
+        with self.lock:
+            self.joined[room] = time.time()
+            self.joined.move_to_end(room)
+            evict = self.evict(len(self.joined) - self.max_rooms)
+        self.leave(evict)
+
+    def release(self, room):
+        if room in self.pinned:
+            return
+        with self.lock:
+            self.unuse(room)
+            if room in self.joined:
+                self.joined[room] = time.time()
+
+    def unuse(self, room):
+        # the caller holds the lock
+        self.users[room] -= 1
+        if self.users[room] <= 0:
+            del self.users[room]
+
+    @contextlib.contextmanager
+    def use(self, room):
+        # a failed join raises before the body runs against a room we're not in
+        self.acquire(room)
+        try:
+            yield
+        finally:
+            self.release(room)
+
+    def sweep(self):
+        '''
+        Leave the rooms that have been idle for idle_timeout seconds.
+        '''
+        with self.lock:
+            evict = self.evict(len(self.joined), time.time() - self.idle_timeout)
+        self.leave(evict)
+
+    def forget(self, room):
+        # the room is gone, there is nothing to leave
+        with self.lock:
+            self.joined.pop(room, None)
+
+    def reset(self):
+        '''
+        A new session starts in no rooms. Whatever the plugin still lists
+        from the old one, acquire() only trusts rooms joined since.
+        '''
+        with self.lock:
+            self.joined.clear()
+
+    def evict(self, count, cutoff=None):
+        # take up to count unused rooms, least recently used first and
+        # last used before cutoff if given, off the joined list; the
+        # caller holds the lock and leaves them.
+        rooms = []
+        for room, used in self.joined.items():
+            if len(rooms) >= count:
+                break
+            if not self.users[room] and (cutoff is None or used < cutoff):
+                rooms.append(room)
+        for room in rooms:
+            del self.joined[room]
+        self.leaving.update(rooms)
+        return rooms
+
+    def leave(self, rooms):
+        for room in rooms:
+            log.info("Leaving idle groupchat %s", room, extra={'room': room})
+            self.xmpp.occupants.forget(room)
+            try:
+                self.xmpp.plugin['xep_0045'].leaveMUC(room, self.xmpp.nick)
+            except:
+                log.exception("Unable to leave %s", room)
+            finally:
+                with self.lock:
+                    self.leaving.discard(room)
+                    self.left.notify_all()
+
 
 class MUCBot(sleekxmpp.ClientXMPP):
 
@@ -65,7 +555,7 @@ class MUCBot(sleekxmpp.ClientXMPP):
     A simple SleekXMPP bot that adds conference rooms.
     """
 
-    def __init__(self, jid, password, room, nick):
+    def __init__(self, jid, password, room, nick, bulk=None, shard=0, shards=1):
         sleekxmpp.ClientXMPP.__init__(self,
                                       jid,
                                       password,
@@ -78,10 +568,63 @@ class MUCBot(sleekxmpp.ClientXMPP):
 
         self.room = room
         self.nick = nick
+
+        # with --shards every bot process handles the rooms that hash to it
+        self.shard = shard
+        self.shards = shards
+        self.ring = HashRing(range(shards))
+
+        # (room, owner) pairs to create in --bulk mode
+        self.bulk = bulk if bulk is None else [job for job in bulk if self.owns(job[0])]
         self.uptime = int(time.time())
 
-        logging.basicConfig(level=logging.DEBUG,
-                    format='%(levelname)-8s %(message)s')
+        # commands run on a worker pool so a slow room operation never
+        # blocks the event thread; commands on the same room are serialized.
+        self.workers = ThreadPoolExecutor(max_workers=WORKERS)
+        self.room_locks = {}
+        self.room_locks_lock = threading.Lock()
+
+        self.directory = MUCDirectory(self, CONF_DOMAIN)
+
+        self.affiliations = AffiliationCache(self, AFFILIATION_TTL)
+
+        # the config file version in use, see reload_config()
+        self.config_mtime = os.stat(configFile).st_mtime
+        self.config_lock = threading.Lock()
+
+        # the periodic jobs of schedule_jobs()
+        self.jobs = None
+
+        self.occupants = OccupantIndex()
+        self.admins = frozenset()
+        self.reload_admins(ADMINS)
+
+        # rooms we stay joined to between commands, never the control room
+        self.memberships = RoomMemberships(self, MAX_JOINED_ROOMS, ROOM_IDLE_TIMEOUT,
+                                           pinned=(room,))
+
+        # room -> (fetched at, {var: (type, value)}) of its config form
+        self.room_configs = {}
+        self.room_configs_lock = threading.Lock()
+
+        self.metrics = GraphiteSender(GRAPHITE_ADDR,
+                                      protocol=GRAPHITE.get('protocol', 'plaintext'),
+                                      batch_size=GRAPHITE.get('batch_size', 100),
+                                      flush_interval=GRAPHITE.get('flush_interval', 5),
+                                      queue_size=GRAPHITE.get('queue_size', 10000))
+
+        # latency and error counts per command and IQ type
+        self.stats = BotMetrics(METRIC_PREFIX + ".roombot")
+        for key in ('queued', 'sent', 'dropped', 'errors'):
+            self.stats.gauge('roombot_graphite_%s' % key,
+                             lambda key=key: self.metrics.stats()[key])
+
+        self.probes = ProbeEngine(self, self.shard_rooms(PING_MUCS), self.metrics.send,
+                                  interval=RTT.get('interval', 60),
+                                  window=RTT.get('window', 300),
+                                  timeout=RTT.get('timeout', 10),
+                                  jitter=RTT.get('jitter'),
+                                  workers=RTT.get('workers', 16))
 
         self.add_event_handler("ssl_invalid_cert", self.discard)
         self.add_event_handler("socket_error", self.reconnect)
@@ -101,12 +644,16 @@ class MUCBot(sleekxmpp.ClientXMPP):
         # will be processed by both handlers.
         self.add_event_handler("groupchat_message", self.muc_message)
 
+        self.add_event_handler("groupchat_config_status", self.config_changed)
+        self.add_event_handler("groupchat_presence", self.presence_affiliation)
+        self.add_event_handler("groupchat_presence", self.presence_occupant)
+
 
     def reconnect(self):
         self.uptime = int(time.time())
 
     def discard(self, event):
-        print("!!!! Ignoring invalid SSL cert\n")
+        log.warning("Ignoring invalid SSL cert")
         return
 
     def start(self, event):
@@ -124,6 +671,12 @@ class MUCBot(sleekxmpp.ClientXMPP):
         """
         #self.get_roster()
         self.send_presence()
+        self.memberships.reset()
+        self.occupants.clear()
+
+        if self.bulk is not None:
+            self.workers.submit(self.run_bulk_file)
+            return
         self.plugin['xep_0045'].joinMUC(self.room,
                                         self.nick,
                                         maxhistory="0", #does not work with CiscoJabber.
@@ -131,49 +684,90 @@ class MUCBot(sleekxmpp.ClientXMPP):
                                         # password=the_room_password,
                                         wait=True)
 
+        #load the room directory and keep it fresh.
+        self.workers.submit(self.refresh_directory)
+        self.schedule_jobs()
+
         #setup ping monitors for declared mucs
-        for muc in PING_MUCS:
-            self.scheduler.add("RTT check : %s" % muc,
-                               seconds=60,
-                               callback=self.rtt,
-                               args=(muc,),
-                               repeat=True,
-                               qpointer=self.event_queue)
-
-    # check round trip using ping.
-    def rtt(self, muc):
-        rtt = self.plugin['xep_0199'].ping(muc)
-        print("PING %s RTT: %f" % (muc, rtt))
+        self.probes.start(self.scheduler)
 
+    def schedule_jobs(self):
+        '''
+        (Re)schedule the periodic jobs with the current settings.
+        '''
+        if self.jobs is None:
+            # the scheduler outlives reconnects, so do the jobs
+            self.jobs = RepeatingJobs(self.scheduler)
+        for name, seconds, callback, args in (
+                ("MUC directory refresh", DIRECTORY_REFRESH,
+                 self.workers.submit, (self.refresh_directory,)),
+                ("MUC membership sweep", min(60, ROOM_IDLE_TIMEOUT),
+                 self.memberships.sweep, None),
+                ("Config watch", CONFIG_POLL,
+                 self.workers.submit, (self.watch_config,)),
+                ("Bot metrics flush", METRICS['interval'],
+                 self.stats.flush, (self.metrics.send,))):
+            self.jobs.set(name, seconds, callback, args)
+
+    def watch_config(self):
         try:
-            ts = int(time.time())
-            ns = "general.voice.minutely.jabber.%s_rtt" % muc.split("@")[0].replace(".", "_")
-            metric = (ns, ts, rtt)
-            self.send_metrics(metric)
-        except:
-            syslog.syslog("Error sending metrics: %s" % str(sys.exc_info()))
+            mtime = os.stat(configFile).st_mtime
+        except OSError:
             return
+        if mtime != self.config_mtime:
+            self.reload_config()
 
+    def reload_config(self):
+        '''
+        Re-read the config file and apply it without reconnecting. An
+        unreadable or invalid file is reported and the running config
+        kept.
+        '''
+        with self.config_lock:
+            try:
+                self.config_mtime = os.stat(configFile).st_mtime
+                params = read_config(configFile)
+            except (IOError, OSError, ValueError, yaml.YAMLError) as err:
+                log.error("Not reloading config file %s: %s", configFile, err)
+                return
+
+            changed = [key for key in RESTART_KEYS if params.get(key) != configParams.get(key)]
+            if changed:
+                log.warning("Config file %s: changes to %s take effect after a restart",
+                            configFile, ", ".join(changed))
+            # until then the running values stay, e.g. the directory and
+            # parse_command() keep agreeing on conf_domain
+            params = dict(params)
+            for key in RESTART_KEYS:
+                if key in configParams:
+                    params[key] = configParams[key]
+                else:
+                    params.pop(key, None)
+
+            relog = LOGGING != dict(LOGGING_DEFAULTS, **(params.get('logging') or {}))
+            apply_config(params)
+            if relog:
+                setup_logging(self.shard, self.shards)
+
+            self.reload_admins(ADMINS)
+            self.affiliations.ttl = AFFILIATION_TTL
+            self.memberships.max_rooms = MAX_JOINED_ROOMS
+            self.memberships.idle_timeout = ROOM_IDLE_TIMEOUT
+            self.probes.reconfigure(self.shard_rooms(PING_MUCS),
+                                    interval=RTT.get('interval', 60),
+                                    window=RTT.get('window', 300),
+                                    timeout=RTT.get('timeout', 10),
+                                    jitter=RTT.get('jitter'))
+            if self.bulk is None:
+                self.schedule_jobs()
+            log.info("Config file %s reloaded", configFile)
 
     def send_metrics(self, metric_tuple):
+        '''
+        Queue a (metric, ts, value) tuple for the graphite sender thread.
+        '''
         (metric, ts, value) = metric_tuple
-        metric = u'{} {} {}\n'.format(
-                    metric,
-                    str(value),
-                    str(ts)
-        )
-        
-        # print("%s" % (metric))
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(2)
-            sock.connect(GRAPHITE_ADDR)
-            sock.sendall(metric.encode('utf-8'))
-            sock.shutdown(socket.SHUT_WR)
-            sock.close()
-            #syslog.syslog("Metrics sent: %s" % metric)
-        except:
-            syslog.syslog("Error sending metrics: %s" % str(sys.exc_info()))
+        self.metrics.send(metric, value, ts)
 
     def muc_message(self, msg):
         """
@@ -197,52 +791,102 @@ class MUCBot(sleekxmpp.ClientXMPP):
                    for stanza objects and the Message stanza to see
                    how it may be used.
         """
-        #this check is required so we don't run commands in history
-        #returned by the jabber server.
-
-
-        if ( int(time.time()) - int(self.uptime) ) > 10:
+        #the only check paid by ordinary chatter in busy rooms.
+        body = msg['body']
+        if not body.startswith('!'):
+            return
 
-            if msg['mucnick'] != self.nick:
-                try:
-                    if msg['body'].startswith('!help'):
-                        self.cmd_help(msg)
+        #rooms the bot stays in between commands are not control rooms.
+        if msg['from'].bare != self.room:
+            return
 
-                    if msg['body'].startswith('!make-room'):
-                        self.cmd_make_room(msg)
+        #this check is required so we don't run commands in history
+        #returned by the jabber server.
+        if ( int(time.time()) - int(self.uptime) ) <= 10:
+            return
 
-                    if msg['body'].startswith('!destroy-room'):
-                        self.cmd_destroy_room(msg)
+        if msg['mucnick'] == self.nick:
+            return
 
-                    if msg['body'].startswith('!set-owner'):
-                        self.cmd_set_owner(msg)
+        cmd = parse_command(body)
+        handler = COMMANDS.get(cmd.name)
+        if handler is None or not self.routes(cmd, body):
+            return
 
-                    if msg['body'].startswith('!drop-owner'):
-                        self.cmd_drop_owner(msg)
+        self.workers.submit(self.run_cmd, handler, msg, cmd)
 
-                    if msg['body'].startswith('!set-admin'):
-                        self.cmd_set_admin(msg)
+    def run_cmd(self, handler, msg, cmd):
+        '''
+        Runs a groupchat command on a worker thread, holding the lock
+        of the room it targets. Multi-room commands hold none: their
+        run_bulk() jobs lock each room, and holding the first one here
+        would leave its job waiting for us forever.
+        '''
+        if cmd.name in MULTIROOM_COMMANDS:
+            self.handle_cmd(handler, msg, cmd)
+            return
+        with self.room_lock(cmd.room or self.room):
+            self.handle_cmd(handler, msg, cmd)
 
-                    if msg['body'].startswith('!drop-admin'):
-                        self.cmd_drop_admin(msg)
+    def handle_cmd(self, handler, msg, cmd):
+        start = time.time()
+        try:
+            with self.stats.timed('command', cmd.name):
+                handler(self, msg, cmd)
+        except:
+           err = "cmd unsuccesful, see bot logs."
+           self.send_message(mto=msg['from'].bare,
+                                 mbody="%s" % err,
+                                 mtype='groupchat')
+           log.exception("%s %s failed", cmd.name, cmd.room,
+                         extra={'command': cmd.name, 'room': cmd.room,
+                                'latency': time.time() - start, 'outcome': 'error'})
+           return
+
+        log.info("%s %s done", cmd.name, cmd.room,
+                 extra={'command': cmd.name, 'room': cmd.room,
+                        'latency': time.time() - start, 'outcome': 'ok'})
+
+    def instrument_iqs(self):
+        '''
+        Time the IQ round trips of the registered plugins, per IQ type.
+        '''
+        self.stats.instrument(self.plugin['xep_0045'], 'iq',
+                              ('getRoomConfig', 'configureRoom', 'setAffiliation', 'setRole',
+                               'destroy', 'getUsersByAffiliation'))
+        self.stats.instrument(self.plugin['xep_0030'], 'iq', ('get_items',))
+        self.stats.instrument(self.plugin['xep_0199'], 'iq', ('send_ping',))
 
-                    if msg['body'].startswith('!kick-alias'):
-                        self.cmd_kick_user(msg)
+    def owns(self, room):
+        return self.shards == 1 or self.ring.node(room.lower()) == self.shard
 
+    def shard_rooms(self, rooms):
+        return [room for room in rooms if self.owns(room)]
 
-                except:
-                   err = "cmd unsuccesful, see bot logs."
-                   self.send_message(mto=msg['from'].bare,
-                                         mbody="%s" % err,
-                                         mtype='groupchat')
-                   print("Dumping Traceback =====\n")
-                   print(sys.exc_info())
-                   print(traceback.print_tb(sys.exc_info()[2]))
-
-                   print("=======================\n")
-                   return
-
-    def cmd_help(self, msg):
+    def routes(self, cmd, body):
+        '''
+        Whether this shard handles cmd: the one owning the room it
+        targets, every one owning a room of a multi-room command, and
+        shard 0 for commands without a room.
+        '''
+        if self.shards == 1:
+            return True
+        if cmd.name in MULTIROOM_COMMANDS:
+            rooms = room_list(body)
+            if rooms:
+                return any(self.owns(room) for room in rooms)
+        if not cmd.room:
+            return self.shard == 0
+        return self.owns(cmd.room)
+
+    def room_lock(self, room):
+        with self.room_locks_lock:
+            if room not in self.room_locks:
+                self.room_locks[room] = threading.Lock()
+            return self.room_locks[room]
+
+    @command('!help', "This msg.")
+    def cmd_help(self, msg, cmd):
         reply = "commands:\n"
 
         for c,h in CMDS.items():
@@ -253,7 +897,8 @@ class MUCBot(sleekxmpp.ClientXMPP):
                           mtype='groupchat')
         return
 
-    def cmd_destroy_room(self, msg):
+    @command('!destroy-room', "Delete a groupchat. (Admin users only)")
+    def cmd_destroy_room(self, msg, cmd):
 
         userJid = self.get_jid(msg)
         if not self.authorized(userJid):
@@ -265,8 +910,7 @@ class MUCBot(sleekxmpp.ClientXMPP):
 
 
         #validate msg length
-        tokens = msg['body'].split(' ')
-        if len(tokens) < 2:
+        if not cmd.room:
             err = "destroy-room: not enough params given.\n"
             err += "Usage: !destroy-room <roomname>\n"
             self.send_message(mto=msg['from'].bare,
@@ -274,7 +918,7 @@ class MUCBot(sleekxmpp.ClientXMPP):
                                       mtype='groupchat')
             return
 
-        room  = self.muc_room(msg)
+        room  = cmd.room
         if not self.muc_exists(room):
             reply = "Room %s doesn't exist." % room
             self.send_message(mto=msg['from'].bare,
@@ -283,6 +927,11 @@ class MUCBot(sleekxmpp.ClientXMPP):
             return
 
         if self.plugin['xep_0045'].destroy(room):
+            self.directory.discard(room)
+            self.forget_room_config(room)
+            self.affiliations.forget(room)
+            self.memberships.forget(room)
+            self.occupants.forget(room)
             reply = "Room %s destroyed." % room
         else:
             reply = "Could not destroy room %s, see logs." % room
@@ -295,15 +944,15 @@ class MUCBot(sleekxmpp.ClientXMPP):
         return
 
 
-    def cmd_set_owner(self, msg):
+    @command('!set-owner', "Set an owner for a groupchat.")
+    def cmd_set_owner(self, msg, cmd):
 
         helpmsg = "Usage: !set-owner <roomname> owner=<user.name>\n"
         helpmsg += "e.g: !set-owner room1408 john.cusack\n"
         helpmsg += "Note: if owner= is not defined, the requesting user is set to owner."
 
         #validate msg length
-        tokens = msg['body'].split(' ')
-        if len(tokens) < 2:
+        if not cmd.room:
             err = "Set owner: not enough params given.\n"
             err += helpmsg
             self.send_message(mto=msg['from'].bare,
@@ -311,17 +960,8 @@ class MUCBot(sleekxmpp.ClientXMPP):
                                       mtype='groupchat')
             return
 
-        room  = self.muc_room(msg)
-        owner = self.muc_owner(msg)
-
-        if not room:
-            err = "Not enough params."
-            err += helpmsg
-            self.send_message(mto=msg['from'].bare,
-                                      mbody="%s" % err,
-                                      mtype='groupchat')
-            return
-
+        room  = cmd.room
+        owner = self.muc_owner(msg, cmd)
 
         if not self.muc_exists(room):
             reply = "Room %s doesn't exist." % room
@@ -330,49 +970,33 @@ class MUCBot(sleekxmpp.ClientXMPP):
                                       mtype='groupchat')
             return
 
-        self.make_room_persistent(room)
-
-        self.plugin['xep_0045'].joinMUC(room, self.nick)
-
-        ret = self.plugin['xep_0045'].setAffiliation( room,
-                                                jid="%s" % (owner),
-                                                affiliation='owner')
-        if ret:
-            reply = "%s added as owner for groupchat %s" % (owner, room)
-        else:
-            reply = "Unable to add %s as owner for groupchat %s, see logs." % (owner, room)
+        ret, reply = self.grant_affiliation(room, owner, 'owner')
 
         self.send_message(mto=msg['from'].bare,
                               mbody=reply,
                               mtype='groupchat')
 
-        self.plugin['xep_0045'].leaveMUC(room, self.nick)
-
         return
 
 
-    def cmd_drop_owner(self, msg):
+    @command('!drop-owner', "Unset groupchat owner - lowers affiliation to member.")
+    def cmd_drop_owner(self, msg, cmd):
 
         helpmsg = "Drop owner: not enough params given.\n"
         helpmsg += "Usage: !drop-owner <roomname> owner=<user.name>\n"
         helpmsg += "e.g: !drop-owner room1408 owner=john.cusack\n"
 
         #validate msg length
-        tokens = msg['body'].split(' ')
-        if ((len(tokens) < 2) or ('owner=' not in msg['body'])):
+        if not cmd.room or not cmd.args.get('owner'):
             self.send_message(mto=msg['from'].bare,
                               mbody="%s" % helpmsg,
                               mtype='groupchat')
             return
 
-        room  = self.muc_room(msg)
-        owner = self.muc_owner(msg)
+        room  = cmd.room
+        owner = self.muc_owner(msg, cmd)
 
-        ret = self.plugin['xep_0045'].setAffiliation(room, jid="%s" % (owner), affiliation='member')
-        if ret:
-            reply = "removed owner %s for groupchat %s" % (owner, room)
-        else:
-            reply = "Unable to remove owner %s for groupchat %s, see logs." % (owner, room)
+        ret, reply = self.revoke_affiliation(room, owner, 'owner')
 
         self.send_message(mto=msg['from'].bare,
                               mbody=reply,
@@ -380,28 +1004,24 @@ class MUCBot(sleekxmpp.ClientXMPP):
 
         return
 
-    def cmd_drop_admin(self, msg):
+    @command('!drop-admin', "Unset groupchat admin - lowers affiliation to member.")
+    def cmd_drop_admin(self, msg, cmd):
 
         helpmsg = "Drop admin: not enough params given.\n"
         helpmsg += "Usage: !drop-admin <roomname> admin=<user.name>\n"
         helpmsg += "e.g: !drop-admin room1408 admin=john.cusack\n"
 
         #validate msg length
-        tokens = msg['body'].split(' ')
-        if ((len(tokens) < 2) or ('admin=' not in msg['body'])):
+        if not cmd.room or not cmd.args.get('admin'):
             self.send_message(mto=msg['from'].bare,
                               mbody="%s" % helpmsg,
                               mtype='groupchat')
             return
 
-        room  = self.muc_room(msg)
-        admin = self.muc_admin(msg)
+        room  = cmd.room
+        admin = self.muc_admin(msg, cmd)
 
-        ret = self.plugin['xep_0045'].setAffiliation(room, jid="%s" % (admin), affiliation='member')
-        if ret:
-            reply = "removed admin %s for groupchat %s" % (admin, room)
-        else:
-            reply = "Unable to remove admin %s for groupchat %s, see logs." % (admin, room)
+        ret, reply = self.revoke_affiliation(room, admin, 'admin')
 
         self.send_message(mto=msg['from'].bare,
                               mbody=reply,
@@ -410,33 +1030,50 @@ class MUCBot(sleekxmpp.ClientXMPP):
         return
 
 
-    def cmd_set_admin(self, msg):
-
-        helpmsg = "Usage: !set-admin <roomname> admin=<user.name>\n"
-        helpmsg += "e.g: !set-admin room1408 some.person\n"
-        helpmsg += "Note: if admin= is not defined, the requesting user is set to admin."
+    @command('!list-owners', "List the owners and admins of a groupchat.")
+    def cmd_list_owners(self, msg, cmd):
 
-        #validate msg length
-        tokens = msg['body'].split(' ')
-        if len(tokens) < 2:
-            err = "Set admin: not enough params given.\n"
-            err += helpmsg
+        if not cmd.room:
+            err = "List owners: not enough params given.\n"
+            err += "Usage: !list-owners <roomname>\n"
             self.send_message(mto=msg['from'].bare,
                                       mbody="%s" % err,
                                       mtype='groupchat')
             return
 
-        room  = self.muc_room(msg)
-        admin = self.muc_admin(msg)
+        room = cmd.room
+        owners = self.affiliations.get(room, 'owner')
+        admins = self.affiliations.get(room, 'admin')
 
-        if not room:
-            err = "Not enough params."
+        if owners is None or admins is None:
+            reply = "Unable to list owners of groupchat %s, see logs." % room
+        else:
+            reply = "groupchat %s\nowners: %s\nadmins: %s" % (room,
+                        ", ".join(sorted(owners)) or "-",
+                        ", ".join(sorted(admins)) or "-")
+
+        self.send_message(mto=msg['from'].bare,
+                              mbody=reply,
+                              mtype='groupchat')
+
+    @command('!set-admin', "Set an admin for a groupchat.")
+    def cmd_set_admin(self, msg, cmd):
+
+        helpmsg = "Usage: !set-admin <roomname> admin=<user.name>\n"
+        helpmsg += "e.g: !set-admin room1408 some.person\n"
+        helpmsg += "Note: if admin= is not defined, the requesting user is set to admin."
+
+        #validate msg length
+        if not cmd.room:
+            err = "Set admin: not enough params given.\n"
             err += helpmsg
             self.send_message(mto=msg['from'].bare,
                                       mbody="%s" % err,
                                       mtype='groupchat')
             return
 
+        room  = cmd.room
+        admin = self.muc_admin(msg, cmd)
 
         if not self.muc_exists(room):
             reply = "Room %s doesn't exist." % room
@@ -445,34 +1082,22 @@ class MUCBot(sleekxmpp.ClientXMPP):
                                       mtype='groupchat')
             return
 
-        self.make_room_persistent(room)
-
-        self.plugin['xep_0045'].joinMUC(room, self.nick)
-
-        ret = self.plugin['xep_0045'].setAffiliation( room,
-                                                jid="%s" % (admin),
-                                                affiliation='admin')
-        if ret:
-            reply = "%s added as admin for groupchat %s" % (admin, room)
-        else:
-            reply = "Unable to add %s as admin for groupchat %s, see logs." % (admin, room)
+        ret, reply = self.grant_affiliation(room, admin, 'admin')
 
         self.send_message(mto=msg['from'].bare,
                               mbody=reply,
                               mtype='groupchat')
 
-        self.plugin['xep_0045'].leaveMUC(room, self.nick)
-
         return
 
-    def cmd_kick_user(self, msg):
+    @command('!kick-alias', "Kick an alias from the given groupchat. (requires the user Handle/Alias not JID)")
+    def cmd_kick_user(self, msg, cmd):
 
         helpmsg = "Usage: !kick-alias <roomname> alias=<alias>\n"
         helpmsg += "e.g: !kick-alias room1408 alias=foo bar\n"
 
         #validate msg length
-        tokens = msg['body'].split(' ', 2)
-        if len(tokens) < 3:
+        if not cmd.rest:
             err = "Kick alias: not enough params given.\n"
             err += helpmsg
             self.send_message(mto=msg['from'].bare,
@@ -480,7 +1105,7 @@ class MUCBot(sleekxmpp.ClientXMPP):
                                       mtype='groupchat')
             return
 
-        if 'alias=' not in tokens[2]:
+        if 'alias=' not in cmd.rest:
             err = "Kick alias: not enough params given.\n"
             err += helpmsg
             self.send_message(mto=msg['from'].bare,
@@ -488,8 +1113,8 @@ class MUCBot(sleekxmpp.ClientXMPP):
                                       mtype='groupchat')
             return
 
-        room  = self.muc_room(msg)
-        alias_tokens = tokens[2].split("=")
+        room  = cmd.room
+        alias_tokens = cmd.rest.split("=")
 
         if not room or len(alias_tokens) < 2:
             err = "alias or groupchat provided is incorrect."
@@ -501,12 +1126,10 @@ class MUCBot(sleekxmpp.ClientXMPP):
 
         alias = alias_tokens[1]
 
-        if room not in self.plugin['xep_0045'].getJoinedRooms():
-            self.plugin['xep_0045'].joinMUC(room, self.nick)
-
-        ret = self.plugin['xep_0045'].setRole(room,
-                                                nick="%s" % (alias),
-                                                role='none')
+        with self.memberships.use(room):
+            ret = self.plugin['xep_0045'].setRole(room,
+                                                    nick="%s" % (alias),
+                                                    role='none')
         if ret:
             reply = "%s kicked from groupchat %s" % (alias, room)
         else:
@@ -516,16 +1139,13 @@ class MUCBot(sleekxmpp.ClientXMPP):
                               mbody=reply,
                               mtype='groupchat')
 
-        if room not in self.plugin['xep_0045'].getJoinedRooms():
-            self.plugin['xep_0045'].leaveMUC(room, self.nick)
-
         return
 
-    def cmd_make_room(self, msg):
+    @command('!make-room', "Add a new groupchat.")
+    def cmd_make_room(self, msg, cmd):
 
         #validate msg length
-        tokens = msg['body'].split(' ')
-        if len(tokens) < 2:
+        if not cmd.room:
             err = "Add groupchat: not enough params given.\n"
             err += HELP_MSG
             self.send_message(mto=msg['from'].bare,
@@ -534,10 +1154,119 @@ class MUCBot(sleekxmpp.ClientXMPP):
             return
 
         #carry out action
-        self.add_muc(msg)
+        self.add_muc(msg, cmd)
+
+    @command('!make-rooms', "Add several groupchats with one owner: !make-rooms <room1,room2,...> [owner=user.name]",
+             multiroom=True)
+    def cmd_make_rooms(self, msg, cmd):
+
+        rooms = room_list(msg['body'])
+        if not rooms:
+            err = "Add groupchats: no rooms given.\n"
+            err += "Usage: !make-rooms <room1,room2,...> [owner=user.name]"
+            self.send_message(mto=msg['from'].bare,
+                                      mbody="%s" % err,
+                                      mtype='groupchat')
+            return
+
+        owner = self.muc_owner(msg, cmd)
+        results = self.bulk_create_rooms([(room, owner) for room in self.shard_rooms(rooms)])
+
+        self.send_message(mto=msg['from'].bare,
+                              mbody=bulk_summary("make-rooms", results),
+                              mtype='groupchat')
+
+    @command('!set-owners', "Set one owner for several groupchats: !set-owners <room1,room2,...> owner=user.name",
+             multiroom=True)
+    def cmd_set_owners(self, msg, cmd):
+
+        rooms = room_list(msg['body'])
+        if not rooms or not cmd.args.get('owner'):
+            #with shards, only the owner of the first room answers
+            if not rooms or self.owns(rooms[0]):
+                err = "Set owners: not enough params given.\n"
+                err += "Usage: !set-owners <room1,room2,...> owner=user.name"
+                self.send_message(mto=msg['from'].bare,
+                                          mbody="%s" % err,
+                                          mtype='groupchat')
+            return
+
+        owner = self.muc_owner(msg, cmd)
+        existing = self.directory_snapshot()
+        jobs = []
+        for room in self.shard_rooms(rooms):
+            if room.lower() in existing:
+                jobs.append((room, self.grant_affiliation, (room, owner, 'owner')))
+            else:
+                jobs.append((room, None, "Room %s doesn't exist." % room))
+
+        self.send_message(mto=msg['from'].bare,
+                              mbody=bulk_summary("set-owners", self.run_bulk(jobs)),
+                              mtype='groupchat')
+
+    def bulk_create_rooms(self, pairs):
+        '''
+        Create or take over the rooms in a list of (room, owner) pairs,
+        BULK_CONCURRENCY at a time, against one directory snapshot.
+        '''
+        existing = self.directory_snapshot()
+        return self.run_bulk([(room, self.create_room, (room, owner, room.lower() in existing))
+                              for room, owner in pairs])
+
+    def directory_snapshot(self):
+        try:
+            self.directory.refresh()
+        except:
+            log.exception("MUC directory refresh failed, using cached copy")
+        return self.directory.snapshot()
+
+    def run_bulk(self, jobs):
+        '''
+        Run (room, action, args) jobs with at most BULK_CONCURRENCY in
+        flight, each holding its room lock. A job with no action is
+        reported as failed with args as the reason.
+        Returns a list of (room, success, reply text).
+        '''
+        results = []
+        with ThreadPoolExecutor(max_workers=BULK_CONCURRENCY) as pool:
+            futures = []
+            for room, action, args in jobs:
+                if action is None:
+                    futures.append((room, None, args))
+                else:
+                    futures.append((room, pool.submit(self.locked, room, action, *args), None))
+
+            for room, future, reason in futures:
+                if future is None:
+                    results.append((room, False, reason))
+                    continue
+                try:
+                    ok, reply = future.result()
+                except:
+                    ok, reply = False, "%s: %s" % (room, str(sys.exc_info()[1]))
+                results.append((room, bool(ok), reply))
+        return results
+
+    def locked(self, room, action, *args):
+        with self.room_lock(room):
+            return action(*args)
+
+    def run_bulk_file(self):
+        '''
+        --bulk mode: create the rooms read from the bulk file, print a
+        summary and disconnect.
+        '''
+        try:
+            results = self.bulk_create_rooms(self.bulk)
+            print(bulk_summary("bulk", results))
+        finally:
+            self.disconnect(wait=True)
+
+    def reload_admins(self, admins):
+        self.admins = frozenset(jid.lower() for jid in admins)
 
     def authorized(self, jid):
-        if jid in ADMINS:
+        if jid and jid.lower() in self.admins:
             return True
         else:
             return False
@@ -548,7 +1277,12 @@ class MUCBot(sleekxmpp.ClientXMPP):
         '''
 
         thisRoom = msg['from'].bare
-        jid = self.plugin['xep_0045'].getJidProperty(thisRoom, msg['mucnick'], 'jid')
+        jid = self.occupants.get(thisRoom, msg['mucnick'])
+        if jid:
+            return jid
+
+        #not seen in presence yet, ask the plugin.
+        jid = self.plugin['xep_0045'].getJidProperty(thisRoom, msg['mucnick'], 'jid') or ''
 
         #if theres a resource, strip it.
         if '/' in jid:
@@ -558,129 +1292,236 @@ class MUCBot(sleekxmpp.ClientXMPP):
 
     def make_room_persistent(self, room):
 
-        #2. get the room config as a data form
-        print("<<<<< request room form:%s>>>>>" % room)
+        return self.configure_room(room, {'persistent': 1})
+
+    def configure_room(self, room, values):
+        '''
+        Bring the room configuration in line with values, e.g.
+        {'persistent': 1}. The room's config form is fetched only when
+        it isn't cached (or the cached copy is older than
+        ROOM_CONFIG_TTL), nothing is sent when the values already hold,
+        and otherwise only the differing fields are submitted.
+        Returns True when the room ends up with the requested values.
+        '''
+
+        #2. get the room config as a data form, or our copy of it
+        fields = self.room_config(room)
+
+        changed = dict((var, value) for var, value in values.items()
+                       if var not in fields or form_value(fields[var][1]) != form_value(value))
+        if not changed:
+            log.debug("room %s already configured, nothing to submit", room)
+            return True
+
+        #3. build a submit form holding only the changed fields
+        roomform = self.plugin['xep_0004'].make_form(ftype='submit')
+        if 'FORM_TYPE' in fields:
+            roomform.add_field(var='FORM_TYPE', ftype='hidden', value=fields['FORM_TYPE'][1])
+        for var, value in changed.items():
+            roomform.add_field(var=var, ftype=fields.get(var, (None, None))[0], value=value)
+        log.debug("set room %s values %s", room, changed)
+
+        ##4. submit the form, this blocks until the server answers the IQ
+        ret = self.plugin['xep_0045'].configureRoom(room, form=roomform)
+        if not ret:
+            # some servers want the whole form back
+            log.info("room %s refused a partial config form, submitting full form", room)
+            roomform = self.plugin['xep_0045'].getRoomConfig(room)
+            roomform.set_values(changed)
+            ret = self.plugin['xep_0045'].configureRoom(room, form=roomform)
+        log.debug("submitted room %s values", room)
+
+        with self.room_configs_lock:
+            if ret and room in self.room_configs:
+                fetched, fields = self.room_configs[room]
+                fields = dict(fields)
+                for var, value in changed.items():
+                    fields[var] = (fields.get(var, (None, None))[0], form_value(value))
+                self.room_configs[room] = (fetched, fields)
+            else:
+                self.room_configs.pop(room, None)
+
+        return ret
+
+    def room_config(self, room):
+        '''
+        Cached {var: (type, value)} view of the room's config form.
+        '''
+        with self.room_configs_lock:
+            cached = self.room_configs.get(room)
+        if cached is not None and time.time() - cached[0] < ROOM_CONFIG_TTL:
+            return cached[1]
+
+        log.debug("request room form: %s", room)
         roomform = self.plugin['xep_0045'].getRoomConfig(room)
-        print(roomform)
-        time.sleep(3)
+        fields = dict((var, (field['type'], field.get_value(convert=False)))
+                      for var, field in roomform['fields'].items())
 
+        with self.room_configs_lock:
+            self.room_configs[room] = (time.time(), fields)
+        return fields
 
-        #3. update the form to make the room persistent
-        roomform.set_values({'persistent': 1})
-        print("<<<<< set room values >>>>>")
+    def forget_room_config(self, room):
+        with self.room_configs_lock:
+            self.room_configs.pop(room, None)
 
-        ##4. submit the form
-        self.plugin['xep_0045'].configureRoom(room, form=roomform)
-        print("<<<<< submit room values >>>>>")
-        time.sleep(1)
+    def config_changed(self, msg):
+        # someone changed a room config (status 104), our copy is stale
+        self.forget_room_config(msg['from'].bare)
 
-        return
+    def join_room(self, room, timeout=10):
+        '''
+        Join a room and wait until the server reflects our own presence
+        back, which for a new room also means it has been created.
+        Returns False if that doesn't happen within timeout seconds.
+        '''
+        joined = threading.Event()
 
-    def muc_owner(self, msg):
+        def own_presence(pr):
+            if pr['muc']['nick'] == self.nick:
+                joined.set()
+
+        event = "muc::%s::presence" % room
+        self.add_event_handler(event, own_presence)
+        try:
+            self.plugin['xep_0045'].joinMUC(room, self.nick)
+            return joined.wait(timeout)
+        finally:
+            self.del_event_handler(event, own_presence)
+
+    def muc_owner(self, msg, cmd):
         '''
-        parse and return room owner passed as a parameter
+        return room owner passed as a parameter
         for e.g the msg['body'] contains,
           owner=foo.bar
 
-         this returns foo.bar@domain.tld
-
+         this returns foo.bar@domain.tld, or the sender's jid
+         if no owner was given.
         '''
 
-        owner = ""
-
-        for token in msg['body'].split(' '):
-            if 'owner=' in token:
-                owner = token.split('=')[1].strip()
+        owner = cmd.args.get('owner', '')
 
         if not owner:
             owner = self.get_jid(msg)
 
-        domainpart = '@' + DOMAIN
-        if domainpart not in owner:
-            owner += domainpart
-
-        return owner
+        return self.user_jid(owner)
 
-    def muc_admin(self, msg):
+    def muc_admin(self, msg, cmd):
         '''
-        parse and return room admin passed as a parameter
+        return room admin passed as a parameter
         for e.g the msg['body'] contains,
           admin=foo.bar
 
-         this returns foo.bar@domain.tld
+         this returns foo.bar@domain.tld, or the sender's jid
+         if no admin was given.
         '''
 
-        admin = ""
-
-        for token in msg['body'].split(' '):
-            if 'admin=' in token:
-                admin = token.split('=')[1].strip()
+        admin = cmd.args.get('admin', '')
 
         if not admin:
             admin = self.get_jid(msg)
 
-        domainpart = '@' + DOMAIN
-        if domainpart not in admin:
-            admin += domainpart
+        return self.user_jid(admin)
 
-        return admin
-
-    def muc_user(self, msg):
+    def muc_user(self, cmd):
         '''
-        parse and return user passed as a parameter
+        return user passed as a parameter
         for e.g the msg['body'] contains,
           user=foo.bar
 
          this returns foo.bar@domain.tld
         '''
 
-        user = ""
-
-        for token in msg['body'].split(' '):
-            if 'user=' in token:
-                user = token.split('=')[1].strip()
+        user = cmd.args.get('user', '')
 
         if not user:
             return user
 
+        return self.user_jid(user)
+
+    def user_jid(self, user):
         domainpart = '@' + DOMAIN
         if domainpart not in user:
             user += domainpart
 
         return user
 
+    def grant_affiliation(self, room, jid, affiliation):
+        '''
+        Make room persistent and give jid the owner or admin affiliation,
+        unless the cached affiliation list says it already has it.
+        Returns (success, reply text).
+        '''
 
+        self.make_room_persistent(room)
 
-    def muc_room(self, msg, strip_hashtag=True):
+        current = self.affiliations.get(room, affiliation)
+        if current is not None and jid.lower() in current:
+            return True, "%s is already %s of groupchat %s" % (jid, affiliation, room)
+
+        try:
+            with self.memberships.use(room):
+                ret = self.plugin['xep_0045'].setAffiliation( room,
+                                                        jid="%s" % (jid),
+                                                        affiliation=affiliation)
+        except JoinError:
+            log.warning("unable to join %s", room, extra={'room': room})
+            return False, "Unable to join groupchat %s, see logs." % room
+        if ret:
+            self.affiliations.record(room, jid, affiliation)
+            reply = "%s added as %s for groupchat %s" % (jid, affiliation, room)
+        else:
+            reply = "Unable to add %s as %s for groupchat %s, see logs." % (jid, affiliation, room)
+
+        return ret, reply
+
+    def revoke_affiliation(self, room, jid, affiliation):
         '''
-        returns the muc room name str
+        Lower jid from owner or admin to member, unless the cached
+        affiliation list says it doesn't hold that affiliation.
+        Returns (success, reply text).
         '''
 
-        room = ""
+        current = self.affiliations.get(room, affiliation)
+        if current is not None and jid.lower() not in current:
+            return True, "%s is not %s of groupchat %s" % (jid, affiliation, room)
 
-        tokens = msg['body'].split(' ')
-        room = tokens[1]
+        ret = self.plugin['xep_0045'].setAffiliation(room, jid="%s" % (jid), affiliation='member')
+        if ret:
+            self.affiliations.record(room, jid, 'member')
+            reply = "removed %s %s for groupchat %s" % (affiliation, jid, room)
+        else:
+            reply = "Unable to remove %s %s for groupchat %s, see logs." % (affiliation, jid, room)
 
-        if not strip_hashtag:
-            if '#' in room:
-                room = room.replace('#')
+        return ret, reply
 
-        domainpart = '@' + CONF_DOMAIN
-        if domainpart not in room:
-            room += domainpart
+    def presence_affiliation(self, pr):
+        '''
+        Occupant presence carries the occupant's current affiliation,
+        keep the cached lists in step with it.
+        '''
+        jid = pr['muc']['jid']
+        if jid and jid.bare:
+            self.affiliations.record(pr['muc']['room'], jid.bare, pr['muc']['affiliation'])
+
+    def presence_occupant(self, pr):
+        if pr['type'] == 'unavailable' and pr['muc']['nick'] == self.nick:
+            # we left or were removed from the room
+            self.occupants.forget(pr['muc']['room'])
+            return
+        self.occupants.presence(pr)
 
-        return room
+    def refresh_directory(self):
+        try:
+            count = self.directory.refresh()
+            log.info("MUC directory refreshed: %d rooms", count)
+        except:
+            log.exception("MUC directory refresh failed")
 
     def muc_exists(self, room):
-        results = self['xep_0030'].get_items(jid=CONF_DOMAIN, iterator=True)
+        return room in self.directory
 
-        for muc in results['disco_items']:
-            if room == muc['jid']:
-                return True
-
-        return False
-
-    def add_muc(self, msg):
+    def add_muc(self, msg, cmd):
         '''
         #Ejabberd :
         ('muc#roomconfig_persistentroom',
@@ -693,69 +1534,102 @@ class MUCBot(sleekxmpp.ClientXMPP):
         #Cisco Jabber :
         '''
 
-        owner = self.muc_owner(msg)
-        room  = self.muc_room(msg)
+        owner = self.muc_owner(msg, cmd)
+        room  = cmd.room
 
-        roomexists = 0
+        ok, reply = self.create_room(room, owner, self.muc_exists(room))
 
-        if self.muc_exists(room):
-            roomexists = 1
+        self.send_message(mto=msg['from'].bare,
+                              mbody=reply,
+                              mtype='groupchat')
+
+        return 0
+
+    def create_room(self, room, owner, roomexists):
+        '''
+        Create room, or make an existing one persistent, and set owner.
+        Returns (success, reply text).
+        '''
 
         #1. join the requested muc, if it doesn't get listed in
         #   discovery, this means the room is not adhoc or peristent yet
         #   roombot does not attempt to join the room if it exists,
         #   because it could be locked - waiting to be configured. 
-        if not roomexists:
-            self.plugin['xep_0045'].joinMUC(room, self.nick)
-            print("<<<<< Room doesn't already exist, joined room. >>>>>")
-            #We sleep a bit here so the server doesn't ignore our command to set the room to persistent.
-            time.sleep(5)
-
-        self.make_room_persistent(room)
-        time.sleep(1)
         if roomexists:
-            self.plugin['xep_0045'].joinMUC(room, self.nick)
-            print("<<<<< Room exists, joined room >>>>>")
-            time.sleep(5)
-
+            if self.make_room_persistent(room):
+                self.directory.add(room)
 
-        out = self.plugin['xep_0045'].setAffiliation( room,
-                                                jid="%s" % (owner),
-                                                affiliation='owner')
-        print("<<<<< set affiliation >>>>>")
-        time.sleep(1)
-
-        self.plugin['xep_0045'].invite( room,
-                                        owner,
-                                        reason='Requested room created.')
-       
-        if not roomexists:
+        #wait for the room-created presence so the server doesn't ignore our command to set the room to persistent.
+        #the bot stays in the room afterwards, see RoomMemberships.
+        try:
+            with self.memberships.use(room):
+                if not roomexists:
+                    log.debug("Room %s doesn't already exist, joined room", room)
+                    if self.make_room_persistent(room):
+                        self.directory.add(room)
+                else:
+                    log.debug("Room %s exists, joined room", room)
+
+                ok = self.plugin['xep_0045'].setAffiliation( room,
+                                                        jid="%s" % (owner),
+                                                        affiliation='owner')
+                if ok:
+                    self.affiliations.record(room, owner, 'owner')
+                log.debug("set owner %s of %s", owner, room)
+
+                self.plugin['xep_0045'].invite( room,
+                                                owner,
+                                                reason='Requested room created.')
+        except JoinError:
+            log.warning("unable to join %s", room, extra={'room': room})
+            return False, "%s: unable to join the room, see logs." % room
+
+        if not ok:
+            reply = "%s: unable to set owner %s, see logs." % (room, owner)
+        elif not roomexists:
             reply = "%s added, owner set to %s." % (room, owner)
         else:
             reply = "%s exists, set to persistent and owner set to %s." % (room, owner)
 
-        print("<<<<< invited owner -> %s >>>>>", owner)
-        self.send_message(mto=msg['from'].bare,
-                              mbody=reply,
-                              mtype='groupchat')
-
-        #5. leave muc
-        self.plugin['xep_0045'].leaveMUC(room, self.nick)
+        log.debug("invited owner %s to %s", owner, room)
 
-        return 0
+        return ok, reply
    
-if __name__ == '__main__':
+def setup_logging(shard=0, shards=1):
+    logsetup.setup(level=LOGGING['level'],
+                   fmt=LOGGING['format'],
+                   stanza_sample=LOGGING['stanza_sample'],
+                   context={'shard': shard} if shards > 1 else None)
+
+def run_bot(bulk=None, shard=0, shards=1):
     # Setup the MUCBot and register plugins. Note that while plugins may
     # have interdependencies, the order in which you register them does
     # not matter.
 
-    xmpp = MUCBot(JID, PASS, MUC, ALIAS)
+    setup_logging(shard, shards)
+
+    jid, nick = JID, ALIAS
+    if shards > 1:
+        # every shard is its own session and occupant of the control room
+        jid = "%s/roombot-%d" % (JID.split('/')[0], shard)
+        nick = "%s-%d" % (ALIAS, shard)
+
+    xmpp = MUCBot(jid, PASS, MUC, nick, bulk=bulk, shard=shard, shards=shards)
+    xmpp.register_plugin('xep_0004') # Data Forms
     xmpp.register_plugin('xep_0030') # Service Discovery
     xmpp.register_plugin('xep_0045') # Multi-User Chat
     xmpp.register_plugin('xep_0199') # XMPP Ping
+    xmpp.instrument_iqs()
+
+    if bulk is None and METRICS['port']:
+        # shards listen on consecutive ports
+        xmpp.stats.serve(METRICS['host'], METRICS['port'] + shard)
+
+    # kill -HUP reloads /etc/roombot.yaml, as does editing it
+    signal.signal(signal.SIGHUP, lambda signum, frame: xmpp.workers.submit(xmpp.reload_config))
 
     # Connect to the XMPP server and start processing XMPP stanzas.
-    if xmpp.connect((SERVER, 5222), reattempt=True):
+    if xmpp.connect((SERVER, 5222), reattempt=bulk is None):
         # If you do not have the dnspython library installed, you will need
         # to manually specify the name of the server if it does not match
         # the one in the JID. For example, to use Google Talk you would
@@ -763,8 +1637,96 @@ if __name__ == '__main__':
         #
         # if xmpp.connect(('talk.google.com', 5222)):
         #     ...
-        print("Connecting...")
+        log.info("Connecting...")
         xmpp.process(block=True)
-        print("done.")
+        log.info("done.")
+    else:
+        log.error("Unable to connect.")
+        sys.exit(1)
+
+def run_shard(bulk, shard, shards):
+    # a forked shard starts with the supervisor's handlers and SIGHUP
+    # blocked, see spawn(). Until run_bot() installs its own reload
+    # handler a SIGHUP is ignored; the shard reads the config at start.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGHUP])
+    run_bot(bulk, shard, shards)
+
+def supervise(shards, bulk=None, restart_delay=10):
+    '''
+    Run one bot process per shard and restart those that die, waiting
+    restart_delay seconds between restarts of a shard. In --bulk mode the
+    shards run once and the supervisor returns when all are done.
+    '''
+    setup_logging()
+
+    procs = {}
+    started = {}
+
+    def spawn(shard):
+        proc = multiprocessing.Process(target=run_shard, args=(bulk, shard, shards),
+                                       name="roombot-shard-%d" % shard)
+        # keep forward() from running in the child before run_shard() resets it
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGHUP])
+        try:
+            proc.start()
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGHUP])
+        procs[shard] = proc
+        started[shard] = time.time()
+        log.info("Started shard %d of %d, pid %d", shard, shards, proc.pid)
+
+    def forward(signum, frame):
+        for proc in procs.values():
+            if proc.is_alive():
+                os.kill(proc.pid, signum)
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    # each shard reloads the config itself, pass kill -HUP on to them
+    signal.signal(signal.SIGHUP, forward)
+    # the shards go down with the supervisor, see the finally below
+    signal.signal(signal.SIGTERM, stop)
+
+    for shard in range(shards):
+        spawn(shard)
+
+    try:
+        while procs:
+            time.sleep(1)
+            for shard, proc in list(procs.items()):
+                if proc.is_alive():
+                    continue
+                if bulk is not None:
+                    log.info("Shard %d finished, exit code %s", shard, proc.exitcode)
+                    del procs[shard]
+                elif time.time() - started[shard] >= restart_delay:
+                    log.error("Shard %d died, exit code %s, restarting", shard, proc.exitcode)
+                    spawn(shard)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs.values():
+            if proc.is_alive():
+                proc.terminate()
+        for proc in procs.values():
+            proc.join()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Jabber conference room bot.")
+    parser.add_argument('--bulk', metavar='FILE',
+                        help="create the rooms listed in a CSV (room,owner) or "
+                             "YAML file, print a summary and exit")
+    parser.add_argument('--shards', metavar='N', type=int, default=1,
+                        help="run N bot processes, each handling the rooms "
+                             "that hash to it")
+    args = parser.parse_args()
+
+    bulk = load_bulk_file(args.bulk) if args.bulk else None
+
+    if args.shards > 1:
+        supervise(args.shards, bulk)
     else:
-        print("Unable to connect.")
+        run_bot(bulk)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""
+Concurrent XMPP ping (XEP-0199) probing of conference rooms for roombot.
+"""
+
+import logging
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sleekxmpp.exceptions import IqError, IqTimeout
+
+from jobs import RepeatingJobs
+
+METRIC_PREFIX = "general.voice.minutely.jabber"
+
+log = logging.getLogger(__name__)
+
+
+def percentile(values, pct):
+    '''
+    Nearest-rank percentile of an already sorted list.
+    '''
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class ProbeEngine(object):
+
+    """
+    Pings every target room once per interval.
+
+    Probe start times are spread over the first `jitter` seconds of each
+    round so the rooms aren't all hit at the same instant, and each ping
+    runs on its own worker thread with its own timeout, so a slow room
+    never holds up the others or the XMPP event thread.
+
+    Every sample is emitted as <prefix>.<room>_rtt as before. Every
+    `window` seconds the samples of each room are summarised into
+    _rtt_min, _rtt_p50, _rtt_p95, _rtt_max and _rtt_loss (fraction of
+    probes that timed out) and the window starts over.
+    """
+
+    def __init__(self, xmpp, targets, emit, interval=60, window=300,
+                 timeout=10, jitter=None, workers=16):
+        self.xmpp = xmpp
+        self.emit = emit
+        self.interval = interval
+        self.window = window
+        self.timeout = timeout
+        self.jitter = interval / 2.0 if jitter is None else min(jitter, interval)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.targets = []
+        self.samples = {}
+        self.jobs = None
+        self.set_targets(targets)
+
+    def set_targets(self, targets):
+        with self.lock:
+            self.targets = list(targets)
+            self.samples = dict((room, self.samples.get(room, [])) for room in self.targets)
+
+    def reconfigure(self, targets, interval, window, timeout, jitter=None):
+        '''
+        Apply new settings to a running engine. Samples of rooms that are
+        still targets are kept, and the rounds are only rescheduled when
+        interval or window changed.
+        '''
+        self.set_targets(targets)
+        self.timeout = timeout
+        self.jitter = interval / 2.0 if jitter is None else min(jitter, interval)
+        if (interval, window) != (self.interval, self.window):
+            self.interval = interval
+            self.window = window
+            if self.jobs is not None:
+                self.schedule()
+
+    def start(self, scheduler):
+        # the scheduler outlives reconnects, only schedule once
+        if self.jobs is not None:
+            return
+        self.jobs = RepeatingJobs(scheduler)
+        self.schedule()
+
+    def schedule(self):
+        self.jobs.set("RTT probe round", self.interval, self.probe_round)
+        self.jobs.set("RTT probe stats", self.window, self.flush_stats)
+
+    def probe_round(self):
+        with self.lock:
+            targets = list(self.targets)
+        thread = threading.Thread(target=self.dispatch, args=(targets,),
+                                  name="rtt-dispatch")
+        thread.daemon = True
+        thread.start()
+
+    def dispatch(self, targets):
+        start = time.time()
+        for offset, room in sorted((random.uniform(0, self.jitter), room) for room in targets):
+            delay = start + offset - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.executor.submit(self.probe, room)
+
+    def probe(self, room):
+        start = time.time()
+        try:
+            self.xmpp['xep_0199'].send_ping(room, timeout=self.timeout)
+            rtt = time.time() - start
+        except IqError:
+            # the room answered, if only with an error
+            rtt = time.time() - start
+        except IqTimeout:
+            log.warning("PING %s timed out after %ds", room, self.timeout, extra={'room': room})
+            rtt = None
+        except:
+            log.exception("PING %s failed", room, extra={'room': room})
+            rtt = None
+
+        with self.lock:
+            if room in self.samples:
+                self.samples[room].append(rtt)
+
+        if rtt is None:
+            return
+
+        log.debug("PING %s RTT: %f", room, rtt, extra={'room': room, 'latency': rtt})
+        self.emit(self.metric(room), rtt, int(time.time()))
+
+    def flush_stats(self):
+        with self.lock:
+            samples = self.samples
+            self.samples = dict((room, []) for room in self.targets)
+
+        ts = int(time.time())
+        for room, rtts in samples.items():
+            if not rtts:
+                continue
+            answered = sorted(rtt for rtt in rtts if rtt is not None)
+            self.emit(self.metric(room, 'loss'), 1 - float(len(answered)) / len(rtts), ts)
+            if not answered:
+                continue
+            self.emit(self.metric(room, 'min'), answered[0], ts)
+            self.emit(self.metric(room, 'p50'), percentile(answered, 50), ts)
+            self.emit(self.metric(room, 'p95'), percentile(answered, 95), ts)
+            self.emit(self.metric(room, 'max'), answered[-1], ts)
+
+    def metric(self, room, stat=None):
+        ns = "%s.%s_rtt" % (METRIC_PREFIX, room.split("@")[0].replace(".", "_"))
+        if stat:
+            ns += "_" + stat
+        return ns
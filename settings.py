@@ -1,5 +1,8 @@
 from configparser import ConfigParser
+import threading
+import time
 import psycopg2
+from psycopg2 import extensions, pool
 
 def config(filename='database.ini', section='prod'):
 	# create a parser
@@ -17,15 +20,199 @@ def config(filename='database.ini', section='prod'):
 		raise Exception('Section {0} not found in the {1} file'.format(section, filename))
 	return db
 
+def options(section, defaults, filename='database.ini'):
+	# optional tuning section, every key falls back to its default
+	# and is converted to the type of that default
+	parser = ConfigParser()
+	parser.read(filename)
+
+	opts = dict(defaults)
+	if parser.has_section(section):
+		for key, default in defaults.items():
+			if not parser.has_option(section, key):
+				continue
+			if isinstance(default, bool):
+				opts[key] = parser.getboolean(section, key)
+			elif isinstance(default, int):
+				opts[key] = parser.getint(section, key)
+			elif isinstance(default, float):
+				opts[key] = parser.getfloat(section, key)
+			else:
+				opts[key] = parser.get(section, key)
+	return opts
+
+
+POOL_DEFAULTS = {
+	'minconn': 1,
+	'maxconn': 10,
+	# seconds a request waits for a free connection before giving up
+	'timeout': 5.0,
+	# connections idle for longer than this are pinged before reuse
+	'pingafter': 30.0,
+}
+
+
+class DBPool:
+	"""
+	Bounded, thread safe pool of psycopg2 connections.
+
+	Checkouts block for at most `timeout` seconds once `maxconn`
+	connections are in use, and connections that sat idle for more than
+	`pingafter` seconds are health checked before being handed out.
+	"""
+
+	def __init__(self, params, minconn=1, maxconn=10, timeout=5.0, pingafter=30.0):
+		self.pool = pool.ThreadedConnectionPool(minconn, maxconn, **params)
+		self.slots = threading.BoundedSemaphore(maxconn)
+		self.maxconn = maxconn
+		self.timeout = timeout
+		self.pingafter = pingafter
+		self.lock = threading.Lock()
+		self.lastused = {}
+		self.inuse = 0
+		self.checkouts = 0
+		self.waits = 0
+		self.waittime = 0.0
+		self.timeouts = 0
+		self.discarded = 0
+
+	def getconn(self):
+		start = time.time()
+		if not self.slots.acquire(blocking=False):
+			with self.lock:
+				self.waits += 1
+			if not self.slots.acquire(timeout=self.timeout):
+				with self.lock:
+					self.timeouts += 1
+					self.waittime += time.time() - start
+				raise pool.PoolError('no free connection after %.1fs' % self.timeout)
+		waited = time.time() - start
+
+		try:
+			# every idle connection may have died with the server, and the
+			# one opened in their place has to pass the check as well
+			for attempt in range(self.maxconn + 1):
+				con = self.pool.getconn()
+				if self.healthy(con):
+					break
+				with self.lock:
+					self.discarded += 1
+					self.lastused.pop(id(con), None)
+				self.pool.putconn(con, close=True)
+			else:
+				raise pool.PoolError('no healthy connection after %d attempts' % (self.maxconn + 1))
+		except Exception:
+			self.slots.release()
+			raise
+
+		with self.lock:
+			self.inuse += 1
+			self.checkouts += 1
+			self.waittime += waited
+		return con
+
+	def putconn(self, con):
+		close = bool(con.closed)
+		if not close:
+			try:
+				# end the read transaction so the backend isn't left idle in transaction
+				con.rollback()
+			except psycopg2.Error:
+				close = True
+
+		with self.lock:
+			if close:
+				self.lastused.pop(id(con), None)
+			else:
+				self.lastused[id(con)] = time.time()
+			self.inuse -= 1
+		self.pool.putconn(con, close=close)
+		self.slots.release()
+
+	def healthy(self, con):
+		if con.closed:
+			return False
+		if con.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+			return False
+		with self.lock:
+			idle = time.time() - self.lastused.get(id(con), 0)
+		if idle < self.pingafter:
+			return True
+		try:
+			cursor = con.cursor()
+			cursor.execute('select 1')
+			cursor.close()
+			con.rollback()
+			return True
+		except psycopg2.Error:
+			return False
+
+	def stats(self):
+		with self.lock:
+			return {
+				'maxconn': self.maxconn,
+				'inuse': self.inuse,
+				'checkouts': self.checkouts,
+				'waits': self.waits,
+				'waittime': round(self.waittime, 6),
+				'timeouts': self.timeouts,
+				'discarded': self.discarded,
+			}
+
+	def closeall(self):
+		self.pool.closeall()
+
+
+# parsed once per process, the pool itself is created on first use
+dbparams = None
+dbpool = None
+poollock = threading.Lock()
+
+def getpool():
+	global dbparams, dbpool
+	if dbpool is None:
+		with poollock:
+			if dbpool is None:
+				if dbparams is None:
+					dbparams = config()
+				dbpool = DBPool(dbparams, **options('pool', POOL_DEFAULTS))
+				print('+=========================+')
+				print('|  CONNECTED TO DATABASE  |')
+				print('+=========================+')
+	return dbpool
+
 def connecttodb():
+	# check a connection out of the pool, hand back a cursor on it.
+	# the caller returns it with releasedb(cursor)
 	try:
-		params = config()
-		con = psycopg2.connect(**params)
-		print('+=========================+')
-		print('|  CONNECTED TO DATABASE  |')
-		print('+=========================+')
-		return con.cursor()
+		con = getpool().getconn()
+		try:
+			return con.cursor()
+		except:
+			dbpool.putconn(con)
+			raise
 	except:
 		print('I am unable to connect to the database')
 		con = '0'
-		return con
\ No newline at end of file
+		return con
+
+def releasedb(cursor):
+	con = cursor.connection
+	try:
+		cursor.close()
+	finally:
+		getpool().putconn(con)
+
+def closepool():
+	# close this process's connections. Called in a preloading server's
+	# master before it forks, so no worker inherits the master's sockets
+	global dbpool
+	with poollock:
+		if dbpool is not None:
+			dbpool.closeall()
+			dbpool = None
+
+def poolstats():
+	if dbpool is None:
+		return {'inuse': 0, 'checkouts': 0, 'waits': 0, 'waittime': 0.0, 'timeouts': 0, 'discarded': 0}
+	return dbpool.stats()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+"""
+Consistent hashing of room jids onto roombot shards.
+"""
+
+import bisect
+import hashlib
+
+
+class HashRing(object):
+
+    """
+    Maps keys onto nodes. Every node is placed on the ring at `replicas`
+    points to even out the share of keys it gets, and a key belongs to
+    the first node point at or after its own hash. Adding a node only
+    moves the keys that now fall on its points, so growing from N to N+1
+    shards moves about 1/(N+1) of the rooms.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.replicas = replicas
+        self.points = []
+        self.nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = self.hash("%s-%d" % (node, i))
+            self.nodes[point] = node
+            bisect.insort(self.points, point)
+
+    def node(self, key):
+        if not self.points:
+            raise ValueError("no nodes on the ring")
+        index = bisect.bisect_left(self.points, self.hash(key)) % len(self.points)
+        return self.nodes[self.points[index]]
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
@@ -0,0 +1,91 @@
+-- Per-room archived message counter read by /roomdetails.
+-- Installs the table and the triggers that keep it current. Safe to run
+-- more than once; install and backfill with
+--   flask --app app install-msgcount
+-- which recounts the rooms in small batches, see jsat_msgcount_recount().
+
+create table if not exists jsat_room_msgcount (
+	room_jid text primary key,
+	msgs bigint not null default 0
+);
+
+-- archive rows without a to_jid belong to no room and are not counted;
+-- the triggers must never fail, or the server's own archive write fails with them
+create or replace function jsat_msgcount_insert() returns trigger as $$
+begin
+	if new.to_jid is null then
+		return null;
+	end if;
+	insert into jsat_room_msgcount (room_jid, msgs) values (new.to_jid, 1)
+		on conflict (room_jid) do update set msgs = jsat_room_msgcount.msgs + 1;
+	return null;
+end
+$$ language plpgsql;
+
+create or replace function jsat_msgcount_delete() returns trigger as $$
+begin
+	if old.to_jid is null then
+		return null;
+	end if;
+	update jsat_room_msgcount set msgs = msgs - 1 where room_jid = old.to_jid;
+	return null;
+end
+$$ language plpgsql;
+
+-- a message moved to another room leaves one count and joins the other
+create or replace function jsat_msgcount_update() returns trigger as $$
+begin
+	if old.to_jid is not distinct from new.to_jid then
+		return null;
+	end if;
+	if old.to_jid is not null then
+		update jsat_room_msgcount set msgs = msgs - 1 where room_jid = old.to_jid;
+	end if;
+	if new.to_jid is not null then
+		insert into jsat_room_msgcount (room_jid, msgs) values (new.to_jid, 1)
+			on conflict (room_jid) do update set msgs = jsat_room_msgcount.msgs + 1;
+	end if;
+	return null;
+end
+$$ language plpgsql;
+
+-- truncate fires no row triggers, so an emptied archive empties the counts here
+create or replace function jsat_msgcount_truncate() returns trigger as $$
+begin
+	delete from jsat_room_msgcount;
+	return null;
+end
+$$ language plpgsql;
+
+-- counting starts as soon as the triggers are live; creating them waits for
+-- the archive writes in flight and blocks new ones only until this commits
+drop trigger if exists jsat_msgcount_insert on tc_msgarchive;
+create trigger jsat_msgcount_insert after insert on tc_msgarchive
+	for each row execute procedure jsat_msgcount_insert();
+
+drop trigger if exists jsat_msgcount_delete on tc_msgarchive;
+create trigger jsat_msgcount_delete after delete on tc_msgarchive
+	for each row execute procedure jsat_msgcount_delete();
+
+drop trigger if exists jsat_msgcount_update on tc_msgarchive;
+create trigger jsat_msgcount_update after update of to_jid on tc_msgarchive
+	for each row execute procedure jsat_msgcount_update();
+
+drop trigger if exists jsat_msgcount_truncate on tc_msgarchive;
+create trigger jsat_msgcount_truncate after truncate on tc_msgarchive
+	for each statement execute procedure jsat_msgcount_truncate();
+
+-- backfill: sets the counts of rooms to their archive's row count. The
+-- archive is locked against writes while the batch is counted, so no
+-- message is counted both here and by a trigger; the count replaces
+-- whatever the triggers had added, so a room can be recounted any time.
+-- Call it on a few rooms per transaction to keep the lock short; calling
+-- it on every room at once locks the archive for a full scan
+create or replace function jsat_msgcount_recount(rooms text[]) returns void as $$
+begin
+	lock table tc_msgarchive in share row exclusive mode;
+	insert into jsat_room_msgcount (room_jid, msgs)
+		select room, (select count(*) from tc_msgarchive where to_jid = room) from unnest(rooms) as r(room)
+		on conflict (room_jid) do update set msgs = excluded.msgs;
+end
+$$ language plpgsql;
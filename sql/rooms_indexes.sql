@@ -0,0 +1,15 @@
+-- Indexes backing search and keyset pagination on /rooms.
+-- Safe to run more than once against the tc_* database.
+
+-- q= is a case-insensitive substring match on room_jid and subject,
+-- which a trigram index can serve without scanning tc_rooms.
+create extension if not exists pg_trgm;
+create index if not exists jsat_rooms_jid_trgm on tc_rooms using gin (room_jid gin_trgm_ops);
+create index if not exists jsat_rooms_subject_trgm on tc_rooms using gin (subject gin_trgm_ops);
+
+-- sort=subject walks this index from the (subject, room_jid) cursor.
+-- sort=name uses the primary key on room_jid.
+create index if not exists jsat_rooms_subject_order on tc_rooms ((coalesce(subject, '')), room_jid);
+
+-- occupancy of the rows on a page is counted per room_jid.
+create index if not exists jsat_users_room on tc_users (room_jid);
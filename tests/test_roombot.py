@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+pytest.importorskip('sleekxmpp')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CONFIG = """
+server: xmpp.example.com
+alias: roombot
+jid: roombot@example.com
+pass: secret
+muc: control@conference.example.com
+ping_mucs: []
+domain: example.com
+conf_domain: conference.example.com
+admins: [admin@example.com]
+"""
+
+# roombot reads its config when imported
+with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as configfile:
+    configfile.write(CONFIG)
+os.environ['ROOMBOT_CONFIG'] = configfile.name
+
+import roombot
+
+
+class FakeForm(dict):
+
+    def add_field(self, **kwargs):
+        self.setdefault('added', []).append(kwargs)
+
+
+class FakeMUC(object):
+
+    """
+    The xep_0045 calls room creation makes, answered without a server.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def getJoinedRooms(self):
+        return []
+
+    def getRoomConfig(self, room):
+        return FakeForm(fields={})
+
+    def configureRoom(self, room, form=None):
+        self.calls.append(('configureRoom', room))
+        return True
+
+    def setAffiliation(self, room, jid=None, affiliation=None):
+        self.calls.append(('setAffiliation', room, jid, affiliation))
+        return True
+
+    def invite(self, room, jid, reason=''):
+        self.calls.append(('invite', room, jid))
+
+    def leaveMUC(self, room, nick):
+        self.calls.append(('leaveMUC', room))
+
+
+class FakeForms(object):
+
+    def make_form(self, ftype='form'):
+        return FakeForm()
+
+
+class FakeDisco(object):
+
+    def __init__(self):
+        self.rooms = []
+
+    def get_items(self, jid=None, iterator=False):
+        return {'disco_items': [{'jid': room} for room in self.rooms]}
+
+
+class FakeJID(str):
+
+    @property
+    def bare(self):
+        return self.split('/')[0]
+
+
+@pytest.fixture
+def bot():
+    bot = roombot.MUCBot('roombot@example.com', 'secret', 'control@conference.example.com', 'roombot')
+    bot.plugin = {'xep_0045': FakeMUC(), 'xep_0004': FakeForms(), 'xep_0030': FakeDisco()}
+    bot.join_room = lambda room, timeout=10: True
+    bot.replies = []
+    bot.send_message = lambda mto, mbody, mtype: bot.replies.append(mbody)
+    yield bot
+    bot.metrics.close(timeout=0)
+    bot.workers.shutdown(wait=False)
+
+
+def run_command(bot, body, timeout=10):
+    msg = {'from': FakeJID('control@conference.example.com/admin'), 'body': body}
+    cmd = roombot.parse_command(body)
+    worker = threading.Thread(target=bot.run_cmd, args=(roombot.COMMANDS[cmd.name], msg, cmd))
+    worker.daemon = True
+    worker.start()
+    worker.join(timeout)
+    assert not worker.is_alive(), "%s did not finish" % body
+
+
+@pytest.mark.parametrize('body', ['!make-rooms x owner=alice', '!make-rooms x y owner=alice'])
+def test_make_rooms_first_room_is_not_deadlocked(bot, body):
+    run_command(bot, body)
+
+    rooms = roombot.room_list(body)
+    assert bot.replies == [roombot.bulk_summary('make-rooms', [
+        (room, True, "%s added, owner set to alice@example.com." % room) for room in rooms])]
+    for room in rooms:
+        assert ('setAffiliation', room, 'alice@example.com', 'owner') in bot.plugin['xep_0045'].calls
+        # nothing is left holding the room
+        lock = bot.room_lock(room)
+        assert lock.acquire(False)
+        lock.release()
+
+
+def test_set_owners_first_room_is_not_deadlocked(bot):
+    bot.plugin['xep_0030'].rooms.append('x@conference.example.com')
+
+    run_command(bot, '!set-owners x owner=alice')
+
+    assert bot.replies[0].startswith('set-owners: 1 of 1 rooms done.')
+
+
+def test_failed_join_is_neither_used_nor_joined(bot):
+    bot.join_room = lambda room, timeout=10: False
+
+    with pytest.raises(roombot.JoinError):
+        with bot.memberships.use('x@conference.example.com'):
+            pytest.fail("ran in a room the bot is not in")
+
+    assert not bot.memberships.joined
+    assert not bot.memberships.users
+
+
+def test_make_rooms_reports_failed_join(bot):
+    bot.join_room = lambda room, timeout=10: False
+
+    run_command(bot, '!make-rooms x owner=alice')
+
+    assert "FAIL x@conference.example.com: unable to join the room" in bot.replies[0]
+    assert not [call for call in bot.plugin['xep_0045'].calls if call[0] == 'setAffiliation']
+
+
+def test_commands_from_joined_user_rooms_are_ignored(bot):
+    room = 'x@conference.example.com'
+    bot.uptime = 0
+    bot.workers.submit = lambda *args: pytest.fail("ran a command from %s" % room)
+    with bot.memberships.use(room):
+        pass
+    assert room in bot.memberships.joined
+
+    bot.muc_message({'from': FakeJID(room + '/mallory'), 'mucnick': 'mallory', 'body': '!help'})
+
+
+def test_commands_from_the_control_room_run(bot):
+    bot.uptime = 0
+    submitted = []
+    bot.workers.submit = lambda *args: submitted.append(args)
+
+    bot.muc_message({'from': FakeJID('control@conference.example.com/admin'), 'mucnick': 'admin', 'body': '!help'})
+
+    assert [args[-1].name for args in submitted] == ['!help']
+
+
+def test_sweep_leaves_only_unused_rooms(bot):
+    memberships = bot.memberships
+    memberships.idle_timeout = -1
+    room = 'x@conference.example.com'
+
+    memberships.acquire(room)
+    memberships.sweep()
+    assert room in memberships.joined
+
+    memberships.release(room)
+    memberships.sweep()
+    assert room not in memberships.joined
+    assert ('leaveMUC', room) in bot.plugin['xep_0045'].calls
+
+
+def test_reset_forgets_rooms_without_touching_the_plugin(bot):
+    room = 'x@conference.example.com'
+    with bot.memberships.use(room):
+        pass
+
+    bot.memberships.reset()
+
+    assert not bot.memberships.joined
+    assert not [call for call in bot.plugin['xep_0045'].calls if call[0] == 'leaveMUC']
+
+
+class FakeScheduler(object):
+
+    def __init__(self):
+        self.tasks = []
+
+    def add(self, name, seconds, callback, args=None, kwargs=None, repeat=False):
+        if name in [task[0] for task in self.tasks]:
+            raise ValueError("Key %s already exists" % name)
+        self.tasks.append((name, seconds, callback))
+
+    def fire(self, index):
+        name, seconds, callback = self.tasks.pop(index)
+        callback()
+
+
+def test_replaced_job_stops_and_new_one_repeats():
+    scheduler = FakeScheduler()
+    jobs = roombot.RepeatingJobs(scheduler)
+    runs = []
+
+    jobs.set("job", 10, runs.append, ('old',))
+    jobs.set("job", 5, runs.append, ('new',))
+    assert [task[1] for task in scheduler.tasks] == [10, 5]
+
+    scheduler.fire(0)
+    assert runs == []
+    assert len(scheduler.tasks) == 1
+
+    scheduler.fire(0)
+    scheduler.fire(0)
+    assert runs == ['new', 'new']
+    assert [task[1] for task in scheduler.tasks] == [5]
+
+    jobs.cancel("job")
+    scheduler.fire(0)
+    assert runs == ['new', 'new']
+    assert not scheduler.tasks
+
+
+def test_reload_keeps_conf_domain_until_restart(bot):
+    bot.jobs = roombot.RepeatingJobs(FakeScheduler())
+    try:
+        with open(roombot.configFile, 'w') as config:
+            config.write(CONFIG.replace('conf_domain: conference.example.com',
+                                        'conf_domain: muc.example.com'))
+        bot.reload_config()
+
+        assert roombot.CONF_DOMAIN == 'conference.example.com'
+        assert bot.directory.domain == roombot.CONF_DOMAIN
+        assert roombot.parse_command('!make-room x').room == 'x@conference.example.com'
+    finally:
+        with open(roombot.configFile, 'w') as config:
+            config.write(CONFIG)
+        bot.reload_config()
+
+
+@pytest.mark.parametrize('metrics', ['{interval: 0}', '{interval: -5}', '{interval: soon}',
+                                     '{port: http}', '{port: -1}'])
+def test_bad_metrics_settings_are_rejected(tmp_path, metrics):
+    path = tmp_path / 'roombot.yaml'
+    path.write_text(CONFIG + 'metrics: %s\n' % metrics)
+
+    with pytest.raises(ValueError):
+        roombot.read_config(str(path))
+
+
+def test_metrics_settings_are_accepted(tmp_path):
+    path = tmp_path / 'roombot.yaml'
+    path.write_text(CONFIG + 'metrics: {interval: 30, port: 0}\n')
+
+    assert roombot.read_config(str(path))['metrics'] == {'interval': 30, 'port': 0}
@@ -0,0 +1,19 @@
+# production entry point: gunicorn -c gunicorn.conf.py wsgi:app
+import settings
+from app import app
+
+# read database.ini up front so a broken file stops the server at startup
+# rather than failing the first request of every worker
+settings.dbparams = settings.config()
+
+def precompile():
+	# compile every template now. With preload_app this happens once in the
+	# master and the forked workers share the compiled code. The cache is
+	# made unbounded so nothing is evicted and recompiled, and with auto
+	# reload off jinja never stats the files again
+	env = app.jinja_env
+	env.cache = {}
+	for name in env.list_templates(extensions=('html',)):
+		env.get_template(name)
+
+precompile()